@@ -5,76 +5,68 @@ info. Output resulting JSON"""
 import pandas as pd
 import numpy as np
 import argparse
+import intermediate_format
+import json_lines
+from alias_index import AliasIndex
 
 
 def add_nested_hgnc(transcripts, hgnc_df):
-    """ Make nested object HGNC symbols per transcript"""
-
-    def get_hgnc_symbol(transcript_id, hgnc_dict):
-        hgnc_symbols = transcripts.loc[transcript_id]
-        if hgnc_symbols.ndim == 1:
-            if pd.isnull(hgnc_symbols.hgnc_symbol):
-                return hgnc_symbols.hgnc_symbol
-            else:
-                if (hgnc_symbols.hgnc_symbol in hgnc_dict):
-                    return [hgnc_dict[hgnc_symbols.hgnc_symbol]]
-                else:
-                    return [hgnc_symbols.hgnc_symbol]
-        else:
-            symbol_list = []
-            for symbol in hgnc_symbols.hgnc_symbol.values:
-                if (symbol in hgnc_dict):
-                    symbol_list.append(hgnc_dict[symbol])
-                else:
-                    symbol_list.append(symbol)
-            return symbol_list
-
-    hgnc_dict = dict()
-    for index, row in hgnc_df.iterrows():
-        for symbol in row['prev_symbol'].split('|'):
-            hgnc_dict[symbol] = index
-
-    hgnc_symbol_list = transcripts.index.drop_duplicates().map(lambda transcript_id: get_hgnc_symbol(transcript_id, hgnc_dict))
+    """ Make nested object HGNC symbols per transcript. Previous HGNC symbols are
+    replaced by the approved symbol."""
+
+    # previous symbol -> approved symbol, if a previous symbol occurs more than once the last one is used
+    hgnc_map = pd.Series(AliasIndex.from_table(hgnc_df, ['prev_symbol'], keep='last').aliases, dtype=object)
+
+    symbols = transcripts['hgnc_symbol']
+    approved_symbols = symbols.map(hgnc_map).where(symbols.isin(hgnc_map.index), symbols)
+
+    # one list of symbols per transcript, in order of first occurrence. A transcript with only
+    # one row and no symbol gets NaN instead of a list.
+    grouped_symbols = approved_symbols.groupby(level=0, sort=False)
+    hgnc_symbol_list = grouped_symbols.agg(list)
+    no_symbol = (grouped_symbols.size() == 1) & grouped_symbols.first().isnull().reindex(hgnc_symbol_list.index)
+    hgnc_symbol_list[no_symbol] = np.nan
+
     # make one row per transcript_stable_id by removing hgnc_symbol
     unique_transcripts = transcripts.copy().reset_index()
     del unique_transcripts['hgnc_symbol']
     unique_transcripts = unique_transcripts.drop_duplicates()
     # should only be one row per transcript now
-    assert (len(unique_transcripts) == len(transcripts.index.drop_duplicates()))
+    assert (len(unique_transcripts) == len(hgnc_symbol_list))
     # should have the same order after dropping duplicates as
     # hgnc_symbol_list
-    assert (0 == (unique_transcripts.transcript_stable_id != transcripts.index.drop_duplicates()).sum())
-    unique_transcripts['hgnc_symbols'] = hgnc_symbol_list
+    assert (0 == (unique_transcripts.transcript_stable_id.values != hgnc_symbol_list.index.values).sum())
+    unique_transcripts['hgnc_symbols'] = hgnc_symbol_list.values
     return unique_transcripts.set_index("transcript_stable_id")
 
 
-def add_nested_transcript_info(transcripts, transcript_info):
-    """ Make nested object with exons and UTR per transcript. """
-
-    def get_list_of_info_dicts(transcript_group):
-        list_of_info_dicts = transcript_group.to_dict(orient='record')
-        for info_dict in list_of_info_dicts:
-            # remove key that's already in the index of group by
-            del info_dict['transcript_id']
+def get_info_dicts_per_transcript(info, columns, transcript_column='transcript_id'):
+    """Return a Series with for every transcript id in info the list of its rows as dictionaries
+    of the given columns, in the order of the rows in info. Rows are sorted by transcript once,
+    so each list is a slice of the rows between two group boundaries."""
+    info = info[info[transcript_column].notnull()]
+    if info.empty:
+        return pd.Series(dtype=object)
+    info = info.sort_values(transcript_column, kind='stable')
+    transcript_ids = info[transcript_column].values
+    info_dicts = [dict(zip(columns, values)) for values in zip(*[info[c].tolist() for c in columns])]
 
-            # For UTRs, remove rank
-            if info_dict['type'] in ['five_prime_UTR', 'three_prime_UTR']:
-                del info_dict['id']
-                del info_dict['rank']
-                del info_dict['version']
+    starts = np.flatnonzero(np.r_[True, transcript_ids[1:] != transcript_ids[:-1]])
+    ends = np.r_[starts[1:], len(info_dicts)]
+    return pd.Series([info_dicts[start:end] for start, end in zip(starts, ends)], index=transcript_ids[starts])
 
-            if info_dict['type'] == 'exon':
-                del info_dict['type']
 
-        return list_of_info_dicts
+def add_nested_transcript_info(transcripts, transcript_info):
+    """ Make nested object with exons and UTR per transcript. """
 
     # Split in exons and UTRs
     exon_info = transcript_info.loc[transcript_info.type == 'exon']
     utr_info = transcript_info.loc[transcript_info.type.isin(['five_prime_UTR', 'three_prime_UTR'])]
 
     # Per transcriptID, take all exons and create a list of exons dictionaries. Save all these lists in a series.
-    series_of_lists_of_exon_dicts = exon_info.groupby('transcript_id').apply(get_list_of_info_dicts)
-    series_of_lists_of_utr_dicts = utr_info.groupby('transcript_id').apply(get_list_of_info_dicts)
+    # Exons leave out the type, UTRs have no id, rank and version.
+    series_of_lists_of_exon_dicts = get_info_dicts_per_transcript(exon_info, ['id', 'start', 'end', 'rank', 'strand', 'version'])
+    series_of_lists_of_utr_dicts = get_info_dicts_per_transcript(utr_info, ['type', 'start', 'end', 'strand'])
 
     # Add a list of exon dictionaries to every transcript
     transcripts['exons'] = transcripts.index.map(series_of_lists_of_exon_dicts)
@@ -86,52 +78,35 @@ def add_nested_transcript_info(transcripts, transcript_info):
 def add_nested_pfam_domains(transcripts, pfam_domains):
     """ Add nested PFAM domains"""
     pfam_domains.columns = [c.lower().replace(' ', '_') for c in pfam_domains.columns]
-    domain_grouped = pfam_domains.groupby("transcript_stable_id")
-
-    def get_domain_for_transcript(x):
-        try:
-            # Fix for: https://github.com/pandas-dev/pandas/issues/9466
-            # use groupby to get indices, loc is slow for non-unique
-            return pfam_domains.iloc[domain_grouped.groups[x]][
-                'pfam_domain_id pfam_domain_start pfam_domain_end'.split()]
-        except KeyError:
-            return np.nan
-
-    transcripts["domains"] = transcripts.index.map(get_domain_for_transcript)
+    domains_per_transcript = get_info_dicts_per_transcript(
+        pfam_domains, 'pfam_domain_id pfam_domain_start pfam_domain_end'.split(), 'transcript_stable_id')
+    transcripts["domains"] = transcripts.index.map(domains_per_transcript)
     return transcripts
 
 
+def get_override_ids(isoform_overrides, column):
+    """Return the ids in column of an isoform overrides table per transcript, without version.
+    Transcripts that are listed more than once are not overridden."""
+    if column not in isoform_overrides.columns:
+        return pd.Series(dtype=object)
+    override_ids = isoform_overrides.loc[~isoform_overrides.index.duplicated(keep=False), column].dropna()
+    return override_ids.str.split('.').str[0]
+
+
 def add_refseq(transcripts, refseq, isoform_overrides_uniprot, isoform_overrides_mskcc):
     """Add one refseq id for each transcript. There can be multiple. Pick
     highest number transcript id in that case."""
     refseq.columns = [c.lower().replace(' ', '_') for c in refseq.columns]
-    refseq_grouped = refseq.groupby("transcript_stable_id")
-
-    def get_refseq_for_transcript(x):
-        # use previously assigned uniprot refseq id
-        try:
-            override_refseq_id = isoform_overrides_uniprot.loc[x]['refseq_id']
-            if hasattr(override_refseq_id, 'split'):
-                return override_refseq_id.split('.')[0]
-        except KeyError:
-            pass
-
-        # use previously assigned mskcc refseq id
-        try:
-            override_refseq_id = isoform_overrides_mskcc.loc[x]['refseq_id']
-            if hasattr(override_refseq_id, 'split'):
-                return override_refseq_id.split('.')[0]
-        except KeyError:
-            pass
-
-        try:
-            # Fix for: https://github.com/pandas-dev/pandas/issues/9466
-            # use groupby to get indices, loc is slow for non-unique
-            return refseq.iloc[refseq_grouped.groups[x]]['refseq_mrna_id'].sort_values(ascending=False).values[0]
-        except KeyError:
-            return np.nan
-
-    transcripts['refseq_mrna_id'] = transcripts.index.map(get_refseq_for_transcript)
+    highest_refseq = refseq.dropna(subset=['refseq_mrna_id']) \
+        .sort_values('refseq_mrna_id', ascending=False) \
+        .drop_duplicates('transcript_stable_id') \
+        .set_index('transcript_stable_id')['refseq_mrna_id']
+
+    # previously assigned uniprot refseq ids go first, then mskcc refseq ids
+    refseq_ids = get_override_ids(isoform_overrides_uniprot, 'refseq_id') \
+        .combine_first(get_override_ids(isoform_overrides_mskcc, 'refseq_id')) \
+        .combine_first(highest_refseq)
+    transcripts['refseq_mrna_id'] = refseq_ids.reindex(transcripts.index).values
     return transcripts
 
 
@@ -143,27 +118,10 @@ def add_ccds(transcripts, ccds, isoform_overrides_uniprot, isoform_overrides_msk
     assert(any(ccds["transcript_stable_id"].duplicated()) == False)
     ccds = ccds.set_index("transcript_stable_id")
 
-    def get_ccds_for_transcript(x):
-        try:
-            override_ccdsid = isoform_overrides_uniprot.loc[x]['ccds_id']
-            if hasattr(override_ccdsid, 'split'):
-                return override_ccdsid.split('.')[0]
-        except KeyError:
-            pass
-
-        try:
-            override_ccdsid = isoform_overrides_mskcc.loc[x]['ccds_id']
-            if hasattr(override_ccdsid, 'split'):
-                return override_ccdsid.split('.')[0]
-        except KeyError:
-            pass
-
-        try:
-            return ccds.loc[x].values[0]
-        except KeyError:
-            return np.nan
-
-    transcripts["ccds_id"] = transcripts.index.map(get_ccds_for_transcript)
+    ccds_ids = get_override_ids(isoform_overrides_uniprot, 'ccds_id') \
+        .combine_first(get_override_ids(isoform_overrides_mskcc, 'ccds_id')) \
+        .combine_first(ccds['ccds_id'])
+    transcripts["ccds_id"] = ccds_ids.reindex(transcripts.index).values
     return transcripts
 
 
@@ -175,13 +133,7 @@ def add_uniprot(transcripts, uniprot):
     assert(any(uniprot["enst_id"].duplicated()) == False)
     uniprot = uniprot.set_index("enst_id")
 
-    def get_uniprot_for_transcript(x):
-        try:
-            return uniprot.loc[x].values[0]
-        except KeyError:
-            return np.nan
-
-    transcripts["uniprot_id"] = transcripts.index.map(get_uniprot_for_transcript)
+    transcripts["uniprot_id"] = uniprot["final_uniprot_id"].reindex(transcripts.index).values
     return transcripts
 
 def main(ensembl_biomart_transcripts,
@@ -193,12 +145,13 @@ def main(ensembl_biomart_transcripts,
          isoform_overrides_uniprot,
          isoform_overrides_mskcc,
          hgnc_symbol_set,
-         ensembl_biomart_transcripts_json
+         ensembl_biomart_transcripts_json,
+         threads=1
          ):
 
     # Read input and set index column
-    transcripts = pd.read_csv(ensembl_biomart_transcripts, sep='\t')
-    transcript_info = pd.read_csv(ensembl_transcript_info, sep="\t")
+    transcripts = intermediate_format.read_table(ensembl_biomart_transcripts)
+    transcript_info = intermediate_format.read_table(ensembl_transcript_info)
     pfam_domains = pd.read_csv(ensembl_biomart_pfam, sep='\t')
     transcripts.set_index('transcript_stable_id', inplace=True)
 
@@ -222,18 +175,17 @@ def main(ensembl_biomart_transcripts,
     enst_to_uniprot_map = pd.read_csv(enst_to_uniprot, sep='\t')
     transcripts = add_uniprot(transcripts, enst_to_uniprot_map)
 
-    # print records as json
-    transcripts.reset_index().to_json(ensembl_biomart_transcripts_json,
-                                      orient='records', lines=True, compression='gzip')
+    # print records as json, one record at a time
+    json_lines.write_json_lines(transcripts.reset_index(), ensembl_biomart_transcripts_json, threads=threads)
 
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description=__doc__,
                                      formatter_class=argparse.RawDescriptionHelpFormatter)
     parser.add_argument("ensembl_biomart_transcripts",
-                        help="tmp/ensembl_biomart_transcripts.txt")
+                        help="tmp/ensembl_biomart_transcripts.txt or .parquet")
     parser.add_argument("ensembl_transcript_info",
-                        help="tmp/ensembl_transcript_info.txt")
+                        help="tmp/ensembl_transcript_info.txt or .parquet")
     parser.add_argument("ensembl_biomart_pfam",
                         help="input/ensembl_biomart_pfam.txt")
     parser.add_argument("ensembl_biomart_refseq",
@@ -249,6 +201,10 @@ if __name__ == '__main__':
     parser.add_argument("hgnc_symbol_set", help="common_input/hgnc_complete_set_2023-10.txt")
     parser.add_argument("ensembl_biomart_transcripts_json",
                         help="tmp/ensembl_biomart_transcripts.json.gz")
+    parser.add_argument("-t", "--threads",
+                        help="The number of threads that compress the JSON output",
+                        default=1,
+                        type=int)
 
     args = parser.parse_args()
     main(args.ensembl_biomart_transcripts,
@@ -260,5 +216,6 @@ if __name__ == '__main__':
          args.vcf2maf_isoform_overrides_uniprot,
          args.vcf2maf_isoform_overrides_mskcc,
          args.hgnc_symbol_set,
-         args.ensembl_biomart_transcripts_json
+         args.ensembl_biomart_transcripts_json,
+         threads=args.threads
          )
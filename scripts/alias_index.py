@@ -0,0 +1,88 @@
+"""Inverted index from gene symbols to approved HGNC symbols.
+
+The index is built once from a table with one row per approved symbol and columns with its
+previous symbols and synonyms, so looking up a symbol does not scan all genes.
+
+Precedence of a lookup:
+ 1. an approved symbol maps to itself
+ 2. otherwise a previous symbol or synonym maps to the approved symbol of the first row that has
+    it (or the last row with keep='last'). Previous symbols and synonyms of the same row have
+    the same precedence.
+
+The alias columns are tokenised the same way for every caller: quotes around a whole cell are
+removed, the cell is split on the separator, each alias is stripped of whitespace and empty
+aliases are dropped. So '"OLD1| OLD2"' gives the aliases OLD1 and OLD2.
+
+The index can be saved as JSON and loaded again, so later runs do not need the full table.
+"""
+
+import json
+import pandas as pd
+
+
+class AliasIndex:
+    """Maps approved symbols, previous symbols and synonyms to the approved symbol"""
+
+    def __init__(self, approved_symbols=(), aliases=None):
+        self.approved_symbols = set(approved_symbols)
+        self.aliases = dict(aliases) if aliases is not None else {}
+
+    @classmethod
+    def from_table(cls, table, alias_columns, separator='|', keep='first'):
+        """Build the index from a table indexed by approved symbol. alias_columns hold separated
+        lists of previous symbols or synonyms, the list items are stripped of whitespace and
+        quotes."""
+        approved_symbols = table.index.values
+        alias_lists = []
+        for column in alias_columns:
+            # index by row number, to keep the order of the table
+            aliases = table[column].reset_index(drop=True).dropna().astype(str) \
+                .str.strip('"').str.split(separator).explode().str.strip()
+            alias_lists.append(pd.DataFrame({'alias': aliases.values,
+                                             'approved_symbol': approved_symbols[aliases.index],
+                                             'row': aliases.index}))
+        all_aliases = pd.concat(alias_lists).sort_values('row', kind='stable')
+        all_aliases = all_aliases[all_aliases['alias'] != ''].drop_duplicates('alias', keep=keep)
+        return cls(table.index.dropna(), zip(all_aliases['alias'], all_aliases['approved_symbol']))
+
+    def get(self, symbol):
+        """Return the approved symbol for symbol, or None if the symbol is unknown"""
+        if symbol in self.approved_symbols:
+            return symbol
+        return self.aliases.get(symbol)
+
+    def __contains__(self, symbol):
+        return symbol in self.approved_symbols or symbol in self.aliases
+
+    def symbols(self):
+        """Return the set of all symbols in the index"""
+        return self.approved_symbols.union(self.aliases)
+
+    def save(self, file_name):
+        with open(file_name, 'w') as index_file:
+            json.dump({'approved_symbols': sorted(self.approved_symbols), 'aliases': self.aliases}, index_file)
+
+    @classmethod
+    def load(cls, file_name):
+        with open(file_name) as index_file:
+            index = json.load(index_file)
+        return cls(index['approved_symbols'], index['aliases'])
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Build an alias index from a gene table and save it as JSON")
+    parser.add_argument("gene_table",
+                        help="common_input/hgnc_complete_set_2023-10.txt or export/ensembl_biomart_canonical_transcripts_per_hgnc.txt")
+    parser.add_argument("alias_index",
+                        help="JSON file the index is written to")
+    parser.add_argument("--symbol_column", default="hgnc_symbol",
+                        help="column with the approved symbols, e.g. symbol for the HGNC complete set")
+    parser.add_argument("--alias_columns", default="previous_symbols,synonyms",
+                        help="comma separated columns with previous symbols and synonyms, e.g. prev_symbol,alias_symbol")
+    parser.add_argument("--separator", default=",",
+                        help="separator of the symbols in the alias columns, | for the HGNC complete set")
+    args = parser.parse_args()
+
+    gene_table = pd.read_csv(args.gene_table, sep='\t', dtype=str).set_index(args.symbol_column)
+    AliasIndex.from_table(gene_table, args.alias_columns.split(','), separator=args.separator).save(args.alias_index)
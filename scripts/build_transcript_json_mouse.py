@@ -9,6 +9,7 @@ A JSON file will be produced that holds for each gene its canonical transcript,
 
 import pandas as pd
 import argparse
+import intermediate_format
 
 def exons_per_transcript(exons):
     '''Builds a nested data frame from exon file for JSON output
@@ -79,10 +80,10 @@ def main(ensembl_biomart_transcripts,
          ensembl_biomart_transcripts_json):
 
     # Read input and set index column
-    transcripts_df = pd.read_csv(ensembl_biomart_transcripts, sep='\t', index_col=0).sort_index()
+    transcripts_df = intermediate_format.read_table(ensembl_biomart_transcripts, index_col=0).sort_index()
     ccds_df = pd.read_csv(ensembl_biomart_ccds, sep='\t', index_col=0).sort_index()
     refseq_df = pd.read_csv(ensembl_biomart_refseq, sep='\t', index_col=0).sort_index()
-    exons_df = pd.read_csv(ensembl_transcript_info, sep='\t')
+    exons_df = intermediate_format.read_table(ensembl_transcript_info)
     pfam_df = pd.read_csv(ensembl_biomart_pfam, sep='\t')
 
     # collapse on transcript
@@ -101,9 +102,9 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser(description=__doc__,
                                      formatter_class=argparse.RawDescriptionHelpFormatter)
     parser.add_argument("ensembl_biomart_transcripts",
-                        help="tmp/ensembl_biomart_transcripts.txt")
+                        help="tmp/ensembl_biomart_transcripts.txt or .parquet")
     parser.add_argument("ensembl_transcript_info",
-                        help="tmp/ensembl_transcript_info.txt")
+                        help="tmp/ensembl_transcript_info.txt or .parquet")
     parser.add_argument("ensembl_biomart_pfam",
                         help="input/ensembl_biomart_pfam.txt")
     parser.add_argument("ensembl_biomart_refseq",
@@ -1,13 +1,13 @@
 import argparse
-import requests
 import pandas as pd
+import http_cache
 
 def main(reference_genome):
     # check if genome is grch37 (hg19), drop grch38 columns if reference_genome is grch37
     drop_columns_name = 'grch38' if reference_genome == 'grch37' else 'grch37'
 
     url ='https://www.oncokb.org/api/v1/utils/allCuratedGenes?includeEvidence=false'
-    oncokb_df = pd.json_normalize(requests.get(url).json())
+    oncokb_df = pd.json_normalize(http_cache.request('GET', url).json())
 
     oncokb_df.drop(list(oncokb_df.filter(regex =drop_columns_name)), axis = 1, inplace = True)
     column_name_mapping = {"background": "background",
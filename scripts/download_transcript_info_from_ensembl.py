@@ -4,44 +4,140 @@
 This script uses the table of gene IDs downloaded from Ensembl BioMart,
 and for each transcript it will query the Ensembl lookup REST API to derive
 whether it is a canonical transcript for that gene, and also the length of 
-the associated protein. The API calls will be done in blocks of <qsize>.
+the associated protein. The API calls will be done in blocks of at most <qsize>, and
+<concurrency> blocks can be requested at the same time. Timeouts and server errors are
+retried with a smaller block size, which grows again after successful requests.
+Results are saved per transcript id in a SQLite checkpoint store next to the output
+file, so an interrupted run continues where it stopped.
 '''
 
 import pandas as pd
 import numpy as np
 import requests
-import sys
 import os
 import argparse
-import re
+import sqlite3
+import time
+import random
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import intermediate_format
+import http_cache
 
+ENSEMBL_GRCH37_SERVER = "https://grch37.rest.ensembl.org"
+ENSEMBL_GRCH38_SERVER = "https://rest.ensembl.org"
 
-def request_transcript_ids(transcripts, grch37):
-    # Prepare API call
+# Ensembl allows 15 requests per second, see https://github.com/Ensembl/ensembl-rest/wiki/Rate-Limits
+ENSEMBL_REQUESTS_PER_SECOND = 15
+
+# Seconds to wait for an Ensembl response before the request is retried
+REQUEST_TIMEOUT = 300
+
+# Number of times a block of transcripts is retried before giving up
+MAX_RETRIES = 8
+
+# Base and maximum of the exponential backoff between retries, in seconds
+BACKOFF_SECONDS = 2
+MAX_BACKOFF_SECONDS = 120
+
+
+class RetryableRequestError(Exception):
+    '''Ensembl request that failed because of a timeout, connection error or server error,
+    and can be retried. retry_after is the wait in seconds requested by the server, if any.'''
+
+    def __init__(self, message, retry_after=None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class TokenBucket:
+    '''Thread-safe token bucket to keep the request rate below a limit.
+    Holds at most <capacity> tokens, refilled at <rate> tokens per second.
+    '''
+
+    def __init__(self, rate, capacity=1):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.last_refill = time.monotonic()
+        self.lock = threading.Lock()
+
+    def pause(self, seconds):
+        '''Hand out no tokens for the given number of seconds, e.g. after a Retry-After header.'''
+        with self.lock:
+            self.tokens = 0
+            self.last_refill = max(self.last_refill, time.monotonic() + seconds)
+
+    def acquire(self):
+        '''Take one token, waiting until one is available.'''
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                if now >= self.last_refill:
+                    self.tokens = min(self.capacity, self.tokens + (now - self.last_refill) * self.rate)
+                    self.last_refill = now
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        return
+                    wait = (1 - self.tokens) / self.rate
+                else:
+                    # paused
+                    wait = self.last_refill - now
+            time.sleep(wait)
+
+
+def get_ensembl_server(grch37):
+    # Ensembl has a dedicated mirror for grch37
     if grch37:
-        server = "https://grch37.rest.ensembl.org"
-    else:
-        server = "https://rest.ensembl.org"
+        return ENSEMBL_GRCH37_SERVER
+    return ENSEMBL_GRCH38_SERVER
+
+
+def request_transcript_ids(transcripts, grch37, server=None, rate_limiter=None):
+    # Prepare API call
+    if server is None:
+        server = get_ensembl_server(grch37)
     ext = "/lookup/id"
     headers = {"Content-Type": "application/json", "Accept": "application/json"}
     transcripts_formatted = '", "'.join(transcripts)
     data = '{"expand": 1, "format":"full", "ids": ["%s"] }' % transcripts_formatted
 
     # Perform API call
+    if rate_limiter is not None:
+        rate_limiter.acquire()
+    # a CacheMissError in offline mode is not retried, it stops the lookup at once
     try:
-        r = requests.post(server+ext, headers=headers, data=data)
-    except requests.exceptions.ConnectionError:
-        sys.stderr.write('Connection error when trying to query Ensembl API')
-        sys.exit(1)
+        r = http_cache.request('POST', server+ext, headers=headers, data=data, timeout=REQUEST_TIMEOUT)
+    except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+        raise RetryableRequestError('Error when trying to query Ensembl API: %s' % e)
+
+    # Too many requests or server error (including Ensembl's own timeouts) can be retried
+    if r.status_code == 429 or r.status_code >= 500:
+        raise RetryableRequestError('Ensembl API returned status %s' % r.status_code,
+                                    get_retry_after(r.headers.get('Retry-After')))
 
     # Check if return JSON is ok
     if not r.ok:
         r.raise_for_status()
-        sys.exit(1)
 
     return r.json()
 
 
+def get_retry_after(retry_after):
+    '''Parse the number of seconds from a Retry-After header, None if absent or not a number.'''
+    try:
+        return float(retry_after)
+    except (TypeError, ValueError):
+        return None
+
+
+def get_backoff(attempt):
+    '''Exponential backoff with jitter, in seconds, for the given retry attempt (starting at 1).'''
+    backoff = min(MAX_BACKOFF_SECONDS, BACKOFF_SECONDS * 2 ** (attempt - 1))
+    return backoff * random.uniform(0.5, 1.5)
+
+
 def get_transcript_info(transcript, ensembl_transcript_response):
     # Attempt to parse API response. Sometimes the transcript does not have an API response, probably because the API is
     # on a newer Ensembl release than the input files. Restarting the pipeline will attempt to continue.
@@ -72,67 +168,181 @@ def get_transcript_info(transcript, ensembl_transcript_response):
     )
 
 
-def get_rest_jobs(tmp_dir, ngenes):
-    '''Reads the tmp dir and determines which indexes still need processing.
+class TranscriptInfoStore:
+    '''Append-only checkpoint store of the Ensembl info per transcript id, in a SQLite database.
+    Every looked up batch is committed at once, so a crash never leaves a partial batch behind.
     '''
 
-    # determine which indices are already processed. Start and stop are derived from filenames.
-    filename_re = re.compile('transcript_info_([0-9]*)-([0-9]*)\.txt$')
-    tmp_files = [fn for fn in os.listdir(tmp_dir) if re.match(filename_re, fn)!=None]
-
-    ngenes_set = set(range(0, ngenes))
-    passed = set()
-    for fn in tmp_files:
-        match = re.search(filename_re, fn)
-        start, end = int(match.group(1)), int(match.group(2))
-        passed.update(range(start, end))
-
-    return ngenes_set.difference(passed)
+    COLUMNS = ['is_canonical', 'protein_stable_id', 'protein_length']
+
+    def __init__(self, file_name):
+        self.connection = sqlite3.connect(file_name, check_same_thread=False)
+        self.lock = threading.Lock()
+        with self.lock, self.connection:
+            self.connection.execute('CREATE TABLE IF NOT EXISTS transcript_info ('
+                                    'transcript_stable_id TEXT PRIMARY KEY, '
+                                    'is_canonical INTEGER, '
+                                    'protein_stable_id TEXT, '
+                                    'protein_length REAL)')
+
+    def stored_transcript_ids(self):
+        with self.lock:
+            return {row[0] for row in self.connection.execute('SELECT transcript_stable_id FROM transcript_info')}
+
+    def save(self, transcript_info_chunk):
+        '''Save a data frame with the info columns, indexed by transcript id.'''
+        rows = [(transcript_id, *[None if pd.isnull(value) else value for value in values])
+                for transcript_id, values in zip(transcript_info_chunk.index,
+                                                 transcript_info_chunk[self.COLUMNS].itertuples(index=False))]
+        with self.lock, self.connection:
+            self.connection.executemany('INSERT OR REPLACE INTO transcript_info VALUES (?, ?, ?, ?)', rows)
+
+    def read_all(self):
+        '''Read the whole store as a data frame indexed by transcript id.'''
+        with self.lock:
+            return pd.read_sql_query('SELECT * FROM transcript_info', self.connection,
+                                     index_col='transcript_stable_id')
+
+    def close(self):
+        self.connection.close()
+
+
+def get_rest_jobs(store, transcripts_all):
+    '''Determines which indexes still need processing: the transcripts that are not in the store yet.
+    '''
+    stored = store.stored_transcript_ids()
+    return set(np.flatnonzero(~transcripts_all.isin(stored)).tolist())
 
 
-def lookup_transcripts(gene_info, tmp_dir, jobs, query_size, grch37=True):
-    '''Loops through gene IDs and looks them up in Ensembl if needed.
-    Results are merged into a data frame.
+class BatchScheduler:
+    '''Hands out batches of transcript indices that still need to be looked up.
+    The batch size is halved after a failed request and grows again after successful requests,
+    up to <max_size>. Failed batches are handed out again, split if the batch size has shrunk.
+    After stop() no more batches are handed out, so the other workers end when one has failed.
     '''
 
-    last_job = len(gene_info)
+    def __init__(self, jobs, max_size, min_size=1):
+        self.pending = sorted(jobs)
+        self.position = 0
+        self.retries = deque()
+        self.max_size = max_size
+        self.min_size = min_size
+        self.size = max_size
+        self.stopped = False
+        self.lock = threading.Lock()
+
+    def next_batch(self):
+        '''Returns a (list of indices, number of previous attempts) tuple, or None when all batches are handed out.'''
+        with self.lock:
+            if self.stopped:
+                return None
+            if self.retries:
+                batch, attempts = self.retries.popleft()
+                if len(batch) > self.size:
+                    self.retries.appendleft((batch[self.size:], attempts))
+                    batch = batch[:self.size]
+                return batch, attempts
+
+            if self.position >= len(self.pending):
+                return None
+            batch = self.pending[self.position:self.position + self.size]
+            self.position += len(batch)
+            return batch, 0
+
+    def success(self):
+        with self.lock:
+            self.size = min(self.max_size, self.size + max(1, self.size // 4))
+
+    def failure(self, batch, attempts):
+        with self.lock:
+            self.size = max(self.min_size, self.size // 2)
+            self.retries.append((batch, attempts))
+
+    def stop(self):
+        with self.lock:
+            self.stopped = True
+
+
+def lookup_transcript_batches(transcripts_all, store, scheduler, grch37, server, rate_limiter):
+    '''Looks up batches from the scheduler in Ensembl until all are done, and saves the info of
+    every batch in the store. Failed requests are retried with exponential backoff. When a batch
+    fails for good, the scheduler is stopped and the error is raised.
+    '''
+    try:
+        lookup_scheduled_batches(transcripts_all, store, scheduler, grch37, server, rate_limiter)
+    except BaseException:
+        scheduler.stop()
+        raise
+
+
+def lookup_scheduled_batches(transcripts_all, store, scheduler, grch37, server, rate_limiter):
+    last_job = len(transcripts_all)
+    while True:
+        next_batch = scheduler.next_batch()
+        if next_batch is None:
+            return
+        batch, attempts = next_batch
+        low_index, high_index = batch[0], batch[-1] + 1
+        transcripts_chunk = transcripts_all.iloc[batch].drop_duplicates()
+        print('Retrieving %s-%s of %s transcripts from Ensembl' % (low_index, high_index, last_job))
+
+        # Request, decode and save info for transcripts
+        start_time = time.monotonic()
+        try:
+            decoded = request_transcript_ids(transcripts_chunk.tolist(), grch37, server, rate_limiter)
+        except RetryableRequestError as e:
+            attempts += 1
+            if attempts > MAX_RETRIES:
+                raise Exception('%s, giving up on %s-%s after %s retries' % (e, low_index, high_index, MAX_RETRIES))
+            if e.retry_after is not None:
+                backoff = e.retry_after
+                rate_limiter.pause(backoff)
+            else:
+                backoff = get_backoff(attempts)
+            print('%s for %s-%s, retrying in %.1fs with a smaller batch size' % (e, low_index, high_index, backoff))
+            time.sleep(backoff)
+            scheduler.failure(batch, attempts)
+            continue
+        elapsed = time.monotonic() - start_time
+        scheduler.success()
+
+        transcript_info_chunk = transcripts_chunk.apply(lambda x: get_transcript_info(x, decoded))
+        transcript_info_chunk.index = transcripts_chunk.values
+        store.save(transcript_info_chunk)
+        print('Retrieved %s-%s in %.1fs: %.0f transcripts/sec' % (low_index, high_index, elapsed,
+                                                                 len(batch) / max(elapsed, 1e-6)))
+
+
+def lookup_transcripts(gene_info, store, jobs, query_size, grch37=True, concurrency=1, server=None):
+    '''Loops through gene IDs and looks them up in Ensembl if needed. Up to <concurrency>
+    batches are requested at the same time, within the Ensembl rate limit.
+    Results are read back from the store in one go, in the order of gene_info.
+    '''
 
     transcripts_all = gene_info['transcript_stable_id']
-    transcript_info = pd.DataFrame({'is_canonical':[], 'protein_stable_id':[], 'protein_length':[]})
+    rate_limiter = TokenBucket(ENSEMBL_REQUESTS_PER_SECOND)
+    scheduler = BatchScheduler(jobs, query_size)
 
     # Iterate over transcripts
-    for low_index in range(0, last_job, query_size):
-        high_index = min(low_index + query_size, last_job)
-        tmp_file = os.path.join(tmp_dir, 'transcript_info_%s-%s.txt' % (low_index, high_index))
-
-        # Check whether we already processed all indices between start and stop, else redo this chunk.
-        if len(set(range(low_index, high_index)).intersection(jobs)) > 0:
-            print('Retrieving %s-%s of %s transcripts from Ensembl' % (low_index, high_index, last_job))
-            transcripts_chunk = transcripts_all[low_index:high_index]
-
-            # Request, decode and save info for transcripts
-            decoded = request_transcript_ids(transcripts_chunk.tolist(), grch37)
-            transcript_info_chunk = transcripts_chunk.apply(lambda x: get_transcript_info(x, decoded))
-            transcript_info_chunk.to_csv(tmp_file, sep='\t', index=True)
-
-    # read all files and append to final table, but keep index
-    filename_re = re.compile('transcript_info_([0-9]*)-([0-9]*)\.txt$')
-    tmp_files = [fn for fn in os.listdir(tmp_dir) if re.match(filename_re, fn)!=None]
-    for fn in tmp_files:
-        transcript_info_chunk = pd.read_csv(os.path.join(tmp_dir, fn), sep='\t', index_col=0)
-        transcript_info = transcript_info.append(transcript_info_chunk, ignore_index=False)
-
-    # Prepare transcript info table for merging. Sort and remove duplicate indices.
-    transcript_info.sort_index(inplace=True)
-    transcript_info = transcript_info.loc[~transcript_info.index.duplicated(keep='first')]
-    transcript_info['is_canonical'].fillna(False, inplace=True)
-    transcript_info['is_canonical'] = transcript_info['is_canonical'].astype(bool)
-    transcript_info['is_canonical'].replace({True: '1', False: '0'}, inplace=True)
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        futures = [executor.submit(lookup_transcript_batches, transcripts_all, store, scheduler,
+                                   grch37, server, rate_limiter)
+                   for _ in range(concurrency)]
+
+        # raise the first error, if any. Batches that were saved are kept for the next run.
+        for future in futures:
+            future.result()
+
+    # Prepare transcript info table for merging: one row per row of gene_info
+    transcript_info = store.read_all().reindex(transcripts_all.values)
+    transcript_info.index = gene_info.index
+    transcript_info['is_canonical'] = transcript_info['is_canonical'].fillna(False).astype(bool)
+    transcript_info['is_canonical'] = transcript_info['is_canonical'].replace({True: '1', False: '0'})
 
     return transcript_info
 
 
-def main(ensembl_biomart_geneids, ensembl_canonical_data, query_size):
+def main(ensembl_biomart_geneids, ensembl_canonical_data, query_size, concurrency=1):
     gene_info = pd.read_csv(ensembl_biomart_geneids, sep='\t', dtype=str)
     gene_info.columns = [c.lower().replace(' ', '_') for c in gene_info.columns]
     # print('Retrieving transcript information per gene to retrieve:\n'
@@ -142,21 +352,18 @@ def main(ensembl_biomart_geneids, ensembl_canonical_data, query_size):
     # print('Can retrieve max 1000 transcripts per POST request, see '
     #       'https://github.com/Ensembl/ensembl-rest/wiki/POST-Requests')
 
-    # Create temporary directory to save files for each transcripts file
-    tmp_dir = os.path.join(os.path.dirname(ensembl_canonical_data), 'transcript_info/')
-    if not os.path.exists(tmp_dir):
-        os.makedirs(tmp_dir)
-
-    ngenes = len(gene_info)
+    # Checkpoint store with the transcripts that were already looked up
+    store = TranscriptInfoStore(os.path.join(os.path.dirname(ensembl_canonical_data), 'transcript_info.sqlite'))
 
     # check if genome is grch37 (hg19) -- Ensembl has a dedicated mirror for grch37
     grch37 = 'grch37' in ensembl_biomart_geneids
 
     # get indexes todo
-    jobs = get_rest_jobs(tmp_dir, ngenes)
+    jobs = get_rest_jobs(store, gene_info['transcript_stable_id'])
 
     # retrieve transcript annotation
-    transcript_info = lookup_transcripts(gene_info, tmp_dir, jobs, query_size, grch37)
+    transcript_info = lookup_transcripts(gene_info, store, jobs, query_size, grch37, concurrency)
+    store.close()
 
     # check whether the total number of jobs is correct
     assert(len(transcript_info.index) == len(gene_info.index))
@@ -165,7 +372,7 @@ def main(ensembl_biomart_geneids, ensembl_canonical_data, query_size):
 
     # merge with gene IDs, save
     gene_transcript_info = pd.concat([gene_info, transcript_info], axis=1, sort=False)
-    gene_transcript_info.to_csv(ensembl_canonical_data, sep='\t', index=False)
+    intermediate_format.write_table(gene_transcript_info, ensembl_canonical_data, intermediate_format.CANONICAL_DATA_SCHEMA)
 
 
 if __name__ == "__main__":
@@ -173,11 +380,16 @@ if __name__ == "__main__":
     parser.add_argument("ensembl_biomart_geneids",
                         help="input/ensembl_biomart_geneids.txt")
     parser.add_argument("ensembl_canonical_data",
-                        help="tmp/ensembl_canonical_data.txt")
+                        help="tmp/ensembl_canonical_data.txt or .parquet")
     parser.add_argument("-q", "--querysize",
-                        help="The number of Ensembl IDs that are submitted per POST request",      
+                        help="The maximum number of Ensembl IDs that are submitted per POST request",      
                         default=1000,
                         type=int)
+    parser.add_argument("-c", "--concurrency",
+                        help="The number of POST requests that are sent to Ensembl at the same time",
+                        default=1,
+                        type=int)
     args = parser.parse_args()
 
-    main(args.ensembl_biomart_geneids, args.ensembl_canonical_data, query_size=args.querysize)
+    main(args.ensembl_biomart_geneids, args.ensembl_canonical_data, query_size=args.querysize,
+         concurrency=args.concurrency)
@@ -0,0 +1,70 @@
+"""Index of the Ensembl canonical transcript per gene id and per hugo symbol.
+
+The index is built once from the transcript table (tmp/ensembl_canonical_data.txt) with one sort
+per key, so resolving many symbols does not sort the transcripts of a gene again for every
+lookup. When there are multiple transcripts, the canonical transcript with largest protein length
+is picked, or if there is no such thing, the one with the biggest gene id.
+"""
+
+import numpy as np
+import pandas as pd
+
+# explanations of a pick
+ONLY_ONE_TRANSCRIPT = "ensembl only one transcript"
+LONGEST_TRANSCRIPT = "ensembl longest"
+
+SORT_COLUMNS = 'is_canonical protein_length gene_stable_id'.split()
+
+
+def pick_ensembl_canonical_per_key(ensembl_table):
+    """Pick one transcript for every index value of ensembl_table. Ties keep the order of
+    ensembl_table. Returns a DataFrame indexed by the index values with the picked
+    gene_stable_id and transcript_stable_id, and an explanation of the pick."""
+    rows = ensembl_table[SORT_COLUMNS + ['transcript_stable_id']].copy()
+    rows['key'] = ensembl_table.index
+    rows = rows[rows['key'].notnull()]
+    # a stable sort on the key first, so the transcripts of each key are sorted like they would
+    # be on their own
+    picks = rows.sort_values(['key'] + SORT_COLUMNS, ascending=[True, False, False, False]) \
+        .drop_duplicates('key') \
+        .set_index('key')[['gene_stable_id', 'transcript_stable_id']]
+    picks.index.name = ensembl_table.index.name
+    transcripts_per_key = rows['key'].value_counts()
+    picks['explanation'] = np.where(transcripts_per_key.reindex(picks.index) == 1,
+                                    ONLY_ONE_TRANSCRIPT, LONGEST_TRANSCRIPT)
+    return picks
+
+
+class EnsemblCanonicalIndex:
+    """Ensembl canonical gene, transcript and explanation per gene id and per hugo symbol"""
+
+    def __init__(self, transcript_info_df):
+        """transcript_info_df has the columns gene_stable_id, transcript_stable_id, hgnc_symbol,
+        is_canonical (bool) and protein_length"""
+        # sort by symbol and then by gene id, ties are picked in this order
+        ensembl_table = transcript_info_df.set_index('hgnc_symbol').sort_index()
+        ensembl_table_indexed_by_gene_stable_id = ensembl_table.set_index(ensembl_table['gene_stable_id'].values).sort_index()
+        self.by_hugo_symbol = pick_ensembl_canonical_per_key(ensembl_table)
+        self.by_gene_stable_id = pick_ensembl_canonical_per_key(ensembl_table_indexed_by_gene_stable_id)
+
+    def resolve(self, hugos, ensembl_gene_ids):
+        """Return the canonical gene, transcript and explanation for every hugo symbol, by its
+        ensembl gene id (same order as hugos). If the gene id has no transcripts, the transcripts
+        of the hugo symbol are used. Returns a DataFrame indexed by hugo symbol, with NaN when no
+        transcript is found."""
+        hugos = pd.Index(hugos)
+        ensembl_gene_ids = pd.Series(ensembl_gene_ids, index=hugos)
+        canonical = self.by_gene_stable_id.reindex(ensembl_gene_ids.values)
+        canonical.index = hugos
+        found_by_gene = ensembl_gene_ids.isin(self.by_gene_stable_id.index).values
+        canonical[~found_by_gene] = self.by_hugo_symbol.reindex(hugos[~found_by_gene])
+        return canonical
+
+    def get(self, hugo_symbol, ensembl_gene_id=None):
+        """Return a (gene_stable_id, transcript_stable_id, explanation) tuple for one hugo symbol,
+        or NaNs when no transcript is found"""
+        if ensembl_gene_id in self.by_gene_stable_id.index:
+            return tuple(self.by_gene_stable_id.loc[ensembl_gene_id])
+        if hugo_symbol in self.by_hugo_symbol.index:
+            return tuple(self.by_hugo_symbol.loc[hugo_symbol])
+        return np.nan, np.nan, np.nan
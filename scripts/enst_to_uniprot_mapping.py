@@ -16,10 +16,10 @@
 # "grch3x_ensemblxx_enst_to_uniprot_mapping_id.txt" is the mapping file with only enst column and uniprot mapping column
 
 import json
+import hashlib
 import re
 import pandas as pd
 import numpy as np
-from Bio import SeqIO
 import wget
 import requests
 from io import StringIO
@@ -27,7 +27,37 @@ import time
 from collections import OrderedDict
 import argparse
 import subprocess
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import Levenshtein
+import http_cache
+import fasta_reader
+
+BIOMART_GRCH37_SERVER = "http://grch37.ensembl.org/biomart/martservice"
+BIOMART_GRCH38_SERVER = "http://www.ensembl.org/biomart/martservice"
+
+# Swiss-Prot id per ENSP id. With completionStamp BioMart ends a complete response with [success].
+BIOMART_QUERY = ('<?xml version="1.0" encoding="UTF-8"?><!DOCTYPE Query>'
+                 '<Query virtualSchemaName="default" formatter="TSV" header="0" uniqueRows="0" count="" '
+                 'datasetConfigVersion="0.6" completionStamp="1">'
+                 '<Dataset name="hsapiens_gene_ensembl" interface="default">'
+                 '<Filter name="ensembl_peptide_id" value="{}"/>'
+                 '<Attribute name="uniprotswissprot"/>'
+                 '<Attribute name="ensembl_peptide_id"/>'
+                 '</Dataset></Query>')
+BIOMART_COMPLETION_STAMP = '[success]'
+
+# ENSP ids per BioMart query, and number of queries sent at the same time
+BIOMART_BATCH_SIZE = 1000
+BIOMART_CONCURRENCY = 4
+
+# Number of times a BioMart query is retried, with exponential backoff between retries in seconds
+BIOMART_MAX_RETRIES = 5
+BIOMART_BACKOFF_SECONDS = 10
+BIOMART_MAX_BACKOFF_SECONDS = 120
+
+# Fetched BioMart results per genome build version, so a rerun only queries new ENSP ids
+BIOMART_STORE_FILE = '../data/uniprot/input/{}_biomart_ensp_to_uniprot.sqlite'
 
 # generate sequence to uniprot id dictionary
 def generate_dict(key, value, dictionary):
@@ -35,85 +65,176 @@ def generate_dict(key, value, dictionary):
         dictionary[key] = []
     dictionary[key].append(value)
 
-def generate_biomart_uniprot(ensp, dictionary):
-    if ensp in dictionary:
-        return dictionary[ensp]
-    return ''
+def get_sequence_digest(sequence):
+    """Fixed-size digest of a protein sequence, the dictionaries are keyed by it instead of the full sequence"""
+    return hashlib.blake2b(sequence.encode(), digest_size=16).digest()
 
-def is_matched(uniprot_id_with_isoform, uniprot_biomart):
-    if ',' in uniprot_id_with_isoform:
-        return False
-    else:
-        if '-' in uniprot_id_with_isoform:
-            uniprot_id = uniprot_id_with_isoform.split('-')[0]
-        else:
-            uniprot_id = uniprot_id_with_isoform
+def read_uniprot_sequences(uniprot_fasta):
+    """Read the UniProt sequences (canonical + isoform). Returns a dict from sequence digest to
+    UniProt ids with isoform, and a dict from sequence length to the sequences with that length"""
+    sequence_to_uniprot_dict = dict()
+    sequence_length_dict = dict()
+    for header, sequence in fasta_reader.read_fasta(uniprot_fasta):
+        # id is e.g. sp|P04637-2|P53_HUMAN
+        uniprot_id = fasta_reader.get_record_id(header).split('|')[1]
+        generate_dict(get_sequence_digest(sequence), uniprot_id, sequence_to_uniprot_dict)
+        generate_dict(len(sequence), sequence, sequence_length_dict)
+    return sequence_to_uniprot_dict, sequence_length_dict
 
-        if uniprot_id == uniprot_biomart:
-            return True
-        else:
-            return False
-
-def get_uniprot_from_biomart(df_transcript, biomart_ensp_to_uniprot_dict, genome_build):
-    start = 0
-    end = 0
-    max_length = len(df_transcript)
-    chunk = 400
-    while (start < max_length):
-        if (start + chunk) >= max_length:
-            end = max_length
+def read_ensembl_sequences(ensembl_fasta, sequence_to_uniprot_dict):
+    """Read the Ensembl peptide sequences. Returns a dict from ENSP id (without version) to
+    sequence digest, and a dict from ENSP id to sequence for the sequences that are not in
+    sequence_to_uniprot_dict. Only those are needed to find UniProt sequences with one
+    substitution."""
+    ensp_to_sequence_digest_dict = dict()
+    unmatched_ensp_to_sequence_dict = dict()
+    for header, sequence in fasta_reader.read_fasta(ensembl_fasta):
+        ensp = fasta_reader.get_record_id(header).split('.')[0]
+        sequence_digest = get_sequence_digest(sequence)
+        ensp_to_sequence_digest_dict[ensp] = sequence_digest
+        if sequence_digest in sequence_to_uniprot_dict:
+            unmatched_ensp_to_sequence_dict.pop(ensp, None)
         else:
-            end = start + chunk
-        ensp_list = []
-        print("Fetching BioMart for variant #" + str(start) + " to #" + str(end) + ', ' + str(max_length) + ' in total')
-        for i in range(start, end):
-            if df_transcript['ensp_id'][i] != '':
-                ensp_list.append(df_transcript['ensp_id'][i])
-        if len(ensp_list) == 0:
-            start = start + chunk
-            continue
-        if 'grch37' in genome_build.lower():
-            url = "http://grch37.ensembl.org/biomart/martservice?query=%3C?xml%20version=%221.0%22%20encoding=%22UTF-8%22?%3E%20%3C!DOCTYPE%20Query%3E%20%3CQuery%20%20virtualSchemaName%20=%20%22default%22%20formatter%20=%20%22TSV%22%20header%20=%20%220%22%20uniqueRows%20=%20%220%22%20count%20=%20%22%22%20datasetConfigVersion%20=%20%220.6%22%20%3E%20%3CDataset%20name%20=%20%22hsapiens_gene_ensembl%22%20interface%20=%20%22default%22%20%3E%20%3CFilter%20name%20=%20%22ensembl_peptide_id%22%20value%20=%20%22" + ','.join(ensp_list) + "%22/%3E%20%3CAttribute%20name%20=%20%22uniprotswissprot%22%20/%3E%20%3CAttribute%20name%20=%20%22ensembl_peptide_id%22%20/%3E%20%3C/Dataset%3E%20%3C/Query%3E"
+            unmatched_ensp_to_sequence_dict[ensp] = sequence
+    return ensp_to_sequence_digest_dict, unmatched_ensp_to_sequence_dict
+
+class BiomartUniprotStore:
+    """UniProt id per ENSP id fetched from BioMart, in a SQLite database. ENSP ids that BioMart has
+    no rows for are stored without UniProt id, so they are not queried again either."""
+
+    def __init__(self, file_name):
+        self.connection = sqlite3.connect(file_name)
+        with self.connection:
+            self.connection.execute('CREATE TABLE IF NOT EXISTS biomart_uniprot ('
+                                    'ensp_id TEXT PRIMARY KEY, '
+                                    'uniprot_id TEXT)')
+
+    def stored_ensp_ids(self):
+        return {row[0] for row in self.connection.execute('SELECT ensp_id FROM biomart_uniprot')}
+
+    def save(self, ensp_ids, ensp_to_uniprot_dict):
+        with self.connection:
+            self.connection.executemany('INSERT OR REPLACE INTO biomart_uniprot VALUES (?, ?)',
+                                        [(ensp, ensp_to_uniprot_dict.get(ensp)) for ensp in ensp_ids])
+
+    def read_all(self):
+        """Return a dict from ENSP id to UniProt id, for the ENSP ids that BioMart has rows for"""
+        return dict(self.connection.execute('SELECT ensp_id, uniprot_id FROM biomart_uniprot WHERE uniprot_id IS NOT NULL'))
+
+    def close(self):
+        self.connection.close()
+
+def request_uniprot_from_biomart(server, ensp_ids):
+    """Query BioMart for the UniProt ids of ensp_ids, with the XML query as POST body. Connection
+    errors, timeouts, server errors and incomplete responses are retried with exponential backoff,
+    other errors (e.g. a rejected query or a cache miss in offline mode) are raised at once.
+    Returns a dict from ENSP id to UniProt id ('' for an ENSP without Swiss-Prot id)."""
+    query = BIOMART_QUERY.format(','.join(ensp_ids))
+    for attempt in range(1, BIOMART_MAX_RETRIES + 2):
+        try:
+            # incomplete responses are not cached
+            response = http_cache.request('POST', server, data={'query': query},
+                                          is_cacheable=lambda response: response.text.rstrip().endswith(BIOMART_COMPLETION_STAMP))
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+            error = str(e)
         else:
-            url = "http://www.ensembl.org/biomart/martservice?query=%3C?xml%20version=%221.0%22%20encoding=%22UTF-8%22?%3E%20%3C!DOCTYPE%20Query%3E%20%3CQuery%20%20virtualSchemaName%20=%20%22default%22%20formatter%20=%20%22TSV%22%20header%20=%20%220%22%20uniqueRows%20=%20%220%22%20count%20=%20%22%22%20datasetConfigVersion%20=%20%220.6%22%20%3E%20%3CDataset%20name%20=%20%22hsapiens_gene_ensembl%22%20interface%20=%20%22default%22%20%3E%20%3CFilter%20name%20=%20%22ensembl_peptide_id%22%20value%20=%20%22" + ','.join(ensp_list) + "%22/%3E%20%3CAttribute%20name%20=%20%22uniprotswissprot%22%20/%3E%20%3CAttribute%20name%20=%20%22ensembl_peptide_id%22%20/%3E%20%3C/Dataset%3E%20%3C/Query%3E"
-        html = requests.get(url).text
-        if "ERROR" in html:
-            print ("retry: " + str(start) + " to " + str(end))
-            time.sleep(10)
-            continue
-        parsed_html = html.split('\n')
-        for uniprot_with_ensp in parsed_html[:-1]:
-            uniprot = uniprot_with_ensp.split('\t')[0]
-            ensp = uniprot_with_ensp.split('\t')[1]
+            if response.status_code >= 500:
+                error = 'BioMart returned status %s' % response.status_code
+            else:
+                response.raise_for_status()
+                text = response.text.rstrip()
+                # BioMart reports query errors with status 200
+                if 'ERROR' in text:
+                    raise Exception('BioMart query failed: %s' % text[:500])
+                if text.endswith(BIOMART_COMPLETION_STAMP):
+                    break
+                error = 'incomplete BioMart response'
+        if attempt > BIOMART_MAX_RETRIES:
+            raise Exception('%s, giving up after %s retries' % (error, BIOMART_MAX_RETRIES))
+        backoff = min(BIOMART_MAX_BACKOFF_SECONDS, BIOMART_BACKOFF_SECONDS * 2 ** (attempt - 1))
+        print('%s, retrying in %ss' % (error, backoff))
+        time.sleep(backoff)
+
+    biomart_ensp_to_uniprot_dict = dict()
+    for uniprot_with_ensp in text[:-len(BIOMART_COMPLETION_STAMP)].splitlines():
+        if uniprot_with_ensp:
+            uniprot, ensp = uniprot_with_ensp.split('\t')[:2]
             biomart_ensp_to_uniprot_dict[ensp] = uniprot
-        start = start + chunk
+    return biomart_ensp_to_uniprot_dict
 
-def find_uniprot_ids_with_one_levenshtein_distance(ensembl_sequence, ensp_id, sequence_length_dict, sequence_to_uniprot_dict):
-    if ensembl_sequence:
-        potential_uniprot_sequences = sequence_length_dict.get(len(ensembl_sequence))
-    else:
+def get_uniprot_from_biomart(ensp_ids, store, genome_build, server=None, batch_size=BIOMART_BATCH_SIZE, concurrency=BIOMART_CONCURRENCY):
+    """Fetch the UniProt ids of the ENSP ids that are not in the store yet from BioMart, with up to
+    <concurrency> queries at the same time. Returns a dict from ENSP id to UniProt id."""
+    if server is None:
+        server = BIOMART_GRCH37_SERVER if 'grch37' in genome_build.lower() else BIOMART_GRCH38_SERVER
+    stored_ensp_ids = store.stored_ensp_ids()
+    new_ensp_ids = [ensp for ensp in pd.unique(ensp_ids[ensp_ids != '']) if ensp not in stored_ensp_ids]
+    batches = [new_ensp_ids[start:start + batch_size] for start in range(0, len(new_ensp_ids), batch_size)]
+    print("Fetching BioMart for " + str(len(new_ensp_ids)) + " ensp ids in " + str(len(batches)) + " queries")
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        futures = {executor.submit(request_uniprot_from_biomart, server, batch): batch for batch in batches}
+        # the store is only written from this thread, fetched batches are kept when a query fails
+        try:
+            for number, future in enumerate(as_completed(futures), start=1):
+                store.save(futures[future], future.result())
+                print("Fetched BioMart query " + str(number) + " of " + str(len(batches)))
+        except BaseException:
+            # do not send the queries that have not started yet
+            for future in futures:
+                future.cancel()
+            raise
+    return store.read_all()
+
+class OneSubstitutionIndex:
+    """Finds the UniProt sequences at Levenshtein distance 1 of a sequence of the same length.
+
+    Sequences of the same length are at distance 1 only when they differ by one substitution, so
+    either their first or their second half is identical. The index maps the hash of both halves of
+    every sequence in sequence_length_dict to its positions, and a lookup only compares the
+    sequences that share a half instead of all sequences of that length."""
+
+    def __init__(self, sequence_length_dict):
+        self.sequence_length_dict = sequence_length_dict
+        self.half_index = dict()
+        for sequence_length, sequences in sequence_length_dict.items():
+            half = sequence_length // 2
+            for position, sequence in enumerate(sequences):
+                generate_dict((sequence_length, 0, hash(sequence[:half])), position, self.half_index)
+                generate_dict((sequence_length, 1, hash(sequence[half:])), position, self.half_index)
+
+    def find(self, sequence):
+        """Return the sequences at distance 1, in the order of sequence_length_dict"""
+        sequence_length = len(sequence)
+        half = sequence_length // 2
+        positions = set(self.half_index.get((sequence_length, 0, hash(sequence[:half])), []))
+        positions.update(self.half_index.get((sequence_length, 1, hash(sequence[half:])), []))
+        candidates = [self.sequence_length_dict[sequence_length][position] for position in sorted(positions)]
+        return [candidate for candidate in candidates if Levenshtein.distance(sequence, candidate) == 1]
+
+def find_uniprot_ids_with_one_levenshtein_distance(ensembl_sequence, ensp_id, one_substitution_index, sequence_to_uniprot_dict):
+    if not ensembl_sequence:
         return None
-    
-    uniprot_ids = []
-    if potential_uniprot_sequences:
-        for uniprot_sequence in potential_uniprot_sequences:
-            if Levenshtein.distance(ensembl_sequence, uniprot_sequence) == 1:
-                uniprot_ids.append(','.join(sequence_to_uniprot_dict.get(uniprot_sequence)))
+
+    uniprot_ids = [','.join(sequence_to_uniprot_dict.get(get_sequence_digest(uniprot_sequence)))
+                   for uniprot_sequence in one_substitution_index.find(ensembl_sequence)]
     if len(uniprot_ids) == 0:
         return None
     else:
         return uniprot_ids
 
-# get uniprot id(isoform) from ensp_to_sequence_dict and add into transcript dataframe
-def get_uniprot_id_with_isoform(ensp, dictionary, sequence_to_uniprot_dict):
-    if ensp in dictionary:
-        seq = dictionary[ensp]
-        if seq in sequence_to_uniprot_dict:
-            uniprot = ','.join(sequence_to_uniprot_dict[seq])
-            return uniprot
-    return ''
+# get uniprot ids(isoform) from ensp_to_sequence_digest_dict and add into transcript dataframe
+def get_uniprot_ids_with_isoform(ensp_ids, ensp_to_sequence_digest_dict, sequence_to_uniprot_dict):
+    """Return the UniProt ids with the same sequence as each ENSP, comma separated, or ''"""
+    sequence_digest_to_uniprot_ids = {sequence_digest: ','.join(uniprot_ids) for sequence_digest, uniprot_ids in sequence_to_uniprot_dict.items()}
+    return ensp_ids.map(ensp_to_sequence_digest_dict).map(sequence_digest_to_uniprot_ids).fillna('')
+
+def get_is_matched(uniprot_ids_with_isoform, biomart_uniprot_ids):
+    """True when there is one UniProt id with the same sequence and it is the BioMart UniProt id"""
+    return ~uniprot_ids_with_isoform.str.contains(',', regex=False) & \
+        (uniprot_ids_with_isoform.str.split('-').str[0] == biomart_uniprot_ids)
 
-def multiple_uniprot_ids_compare_with_biomart(uniprot_id_with_isoform, biomart_uniprot_id, reviewed_mapping_dict):
+def multiple_uniprot_ids_compare_with_biomart(uniprot_id_with_isoform, biomart_uniprot_id):
     uniprot_ids = uniprot_id_with_isoform.split(',')
     final_uniprot_id = None
     for uniprot_id in uniprot_ids:
@@ -125,41 +246,53 @@ def multiple_uniprot_ids_compare_with_biomart(uniprot_id_with_isoform, biomart_u
             final_uniprot_id = uniprot_id
     return final_uniprot_id
 
-def curation(uniprot_id_with_isoform, biomart_uniprot_id, ensp_id, ensp_to_sequence_dict, reviewed_mapping_dict, sequence_length_dict, sequence_to_uniprot_dict):
+def curate_by_levenshtein_distance(ensembl_sequence, biomart_uniprot_id, ensp_id, one_substitution_index, sequence_to_uniprot_dict):
+    """Return the UniProt id for an ENSP without UniProt sequence, from the UniProt sequences with one
+    substitution, or None"""
     final_uniprot_id = None
-    ensembl_sequence = ensp_to_sequence_dict.get(ensp_id)
-        
-    # 0 uniprot ids, 0 or 1 biomart
-    if not uniprot_id_with_isoform:
-        uniprot_ids_with_one_levenshtein_distance = find_uniprot_ids_with_one_levenshtein_distance(ensembl_sequence, ensp_id, sequence_length_dict, sequence_to_uniprot_dict)
-        if uniprot_ids_with_one_levenshtein_distance and len(uniprot_ids_with_one_levenshtein_distance) == 1:
-            final_uniprot_id = uniprot_ids_with_one_levenshtein_distance[0]
-        elif uniprot_ids_with_one_levenshtein_distance and len(uniprot_ids_with_one_levenshtein_distance) > 1 and biomart_uniprot_id and biomart_uniprot_id in uniprot_ids_with_one_levenshtein_distance:
-            final_uniprot_id = multiple_uniprot_ids_compare_with_biomart(','.join(uniprot_ids_with_one_levenshtein_distance), biomart_uniprot_id, reviewed_mapping_dict)
-    
-    else:
-        uniprot_ids_with_isoform = uniprot_id_with_isoform.split(',')
-        # 1 uniprot id, 0 or 1 biomart
-        if len(uniprot_ids_with_isoform) == 1:
-            final_uniprot_id = uniprot_ids_with_isoform[0]
+    uniprot_ids_with_one_levenshtein_distance = find_uniprot_ids_with_one_levenshtein_distance(ensembl_sequence, ensp_id, one_substitution_index, sequence_to_uniprot_dict)
+    if uniprot_ids_with_one_levenshtein_distance and len(uniprot_ids_with_one_levenshtein_distance) == 1:
+        final_uniprot_id = uniprot_ids_with_one_levenshtein_distance[0]
+    elif uniprot_ids_with_one_levenshtein_distance and len(uniprot_ids_with_one_levenshtein_distance) > 1 and biomart_uniprot_id and biomart_uniprot_id in uniprot_ids_with_one_levenshtein_distance:
+        final_uniprot_id = multiple_uniprot_ids_compare_with_biomart(','.join(uniprot_ids_with_one_levenshtein_distance), biomart_uniprot_id)
+    return final_uniprot_id
 
-        # multiple uniprot ids, 0 or 1 biomart
-        elif len(uniprot_ids_with_isoform) > 1:
-            if biomart_uniprot_id and biomart_uniprot_id in uniprot_ids_with_isoform:
-                final_uniprot_id = multiple_uniprot_ids_compare_with_biomart(uniprot_id_with_isoform, biomart_uniprot_id, reviewed_mapping_dict)
+def curation(df_transcript, unmatched_ensp_to_sequence_dict, reviewed_mapping, one_substitution_index, sequence_to_uniprot_dict):
+    """Return the final UniProt id of every transcript, or ''. Only the transcripts without UniProt
+    sequence are curated one by one, by Levenshtein distance."""
+    uniprot_ids_with_isoform = df_transcript['uniprot_id_with_isoform']
+    biomart_uniprot_ids = df_transcript['biomart_uniprot_id']
+    has_multiple_uniprot_ids = uniprot_ids_with_isoform.str.contains(',', regex=False)
+    final_uniprot_ids = pd.Series(None, index=df_transcript.index, dtype=object)
 
-    # if no uniprot id could be mapped, try to find from previous mapping
-    if not final_uniprot_id:
-        if ensp_id in reviewed_mapping_dict:
-            final_uniprot_id = reviewed_mapping_dict.get(ensp_id)[0]
-    
-    if not final_uniprot_id or ',' in final_uniprot_id:
-        final_uniprot_id = ''
+    # 1 uniprot id, 0 or 1 biomart
+    has_one_uniprot_id = (uniprot_ids_with_isoform != '') & ~has_multiple_uniprot_ids
+    final_uniprot_ids[has_one_uniprot_id] = uniprot_ids_with_isoform[has_one_uniprot_id]
 
-    return final_uniprot_id
+    # multiple uniprot ids, 0 or 1 biomart
+    final_uniprot_ids[has_multiple_uniprot_ids] = [
+        multiple_uniprot_ids_compare_with_biomart(uniprot_id_with_isoform, biomart_uniprot_id)
+        if biomart_uniprot_id and biomart_uniprot_id in uniprot_id_with_isoform.split(',') else None
+        for uniprot_id_with_isoform, biomart_uniprot_id
+        in zip(uniprot_ids_with_isoform[has_multiple_uniprot_ids], biomart_uniprot_ids[has_multiple_uniprot_ids])]
+
+    # 0 uniprot ids, 0 or 1 biomart: only the ensp with a sequence can be curated
+    ensembl_sequences = df_transcript['ensp_id'].map(unmatched_ensp_to_sequence_dict)
+    needs_levenshtein_distance = (uniprot_ids_with_isoform == '') & ensembl_sequences.notnull()
+    final_uniprot_ids[needs_levenshtein_distance] = [
+        curate_by_levenshtein_distance(ensembl_sequence, biomart_uniprot_id, ensp_id, one_substitution_index, sequence_to_uniprot_dict)
+        for ensembl_sequence, biomart_uniprot_id, ensp_id
+        in zip(ensembl_sequences[needs_levenshtein_distance], biomart_uniprot_ids[needs_levenshtein_distance],
+               df_transcript['ensp_id'][needs_levenshtein_distance])]
 
+    # if no uniprot id could be mapped, try to find from previous mapping
+    is_mapped = final_uniprot_ids.notnull() & (final_uniprot_ids != '')
+    final_uniprot_ids = final_uniprot_ids.where(is_mapped, df_transcript['ensp_id'].map(reviewed_mapping)).fillna('')
+    final_uniprot_ids[final_uniprot_ids.str.contains(',', regex=False)] = ''
+    return final_uniprot_ids
 
-def main(ensembl_biomart_transcripts, ensembl_fasta, uniprot_sequence_with_isoform, genome_build_version):
+
+def main(ensembl_biomart_transcripts, ensembl_fasta, uniprot_sequence_with_isoform, genome_build_version, biomart_concurrency=BIOMART_CONCURRENCY):
     # extract transcripts
     transcript = open(ensembl_biomart_transcripts)
     if 'grch37' in genome_build_version.lower():
@@ -181,61 +314,27 @@ def main(ensembl_biomart_transcripts, ensembl_fasta, uniprot_sequence_with_isofo
     d = {'enst_id': transcript_ids, 'ensp_id': protein_ids, 'ensembl_protein_length': protein_lengths, 'ccds_id': ccds_ids }
     df_transcript = pd.DataFrame(d)
 
-    # generate ensembl sequence map from ensembl fasta file
-    fasta_sequences = SeqIO.parse(open(ensembl_fasta),'fasta')
-    ensp_to_sequence_dict = dict()
-    for fasta in fasta_sequences:
-        id, sequence = fasta.id, str(fasta.seq)
-        # ensp_to_sequence_dict[ensp] = sequence
-        ensp_to_sequence_dict[id.split('.')[0]] = sequence
-
-    # generate uniprot sequence(with isoform) dictionary from uniprot fasta file    
-    fasta_sequences_uniprot_isoform = SeqIO.parse(open(uniprot_sequence_with_isoform),'fasta')
-    sequence_to_uniprot_dict = dict() # todo some dicts are not using anywhere
-    uniprot_to_gene_dict = dict()
-    uniprot_isoform_dict = dict()
-    uniprot_no_isoform_set = set()
-    sequence_length_dict = dict()
-    for fasta in fasta_sequences_uniprot_isoform:
-        id, sequence = fasta.id, str(fasta.seq)
-        if sequence not in sequence_to_uniprot_dict:
-            sequence_to_uniprot_dict[sequence] = []
-        # sequence_to_uniprot_dict[sequence] = [uniprot_ids]
-        sequence_to_uniprot_dict[sequence].append(id.split('|')[1])
-        
-        # sequence_length_dict[length] = [sequence]
-        sequence_length = len(sequence)
-        if sequence_length not in sequence_length_dict:
-            sequence_length_dict[sequence_length] = []
-        sequence_length_dict[sequence_length].append(sequence)
-        
-        if '-' in id.split('|')[1]:
-            id_temp = id.split('|')[1].split('-')[0]
-        else:
-            id_temp = id.split('|')[1]
-        uniprot_to_gene_dict[id_temp] = id.split('|')[2].split('_')[0]
-        uniprot_no_isoform_set.add(id_temp)
-        
-        if id_temp not in uniprot_isoform_dict:
-            uniprot_isoform_dict[id_temp] = []
-        uniprot_isoform_dict[id_temp].append(id.split('|')[1])
-    
+    # generate uniprot sequence(with isoform) dictionaries from uniprot fasta file, and the ensembl
+    # sequence map from ensembl fasta file
+    sequence_to_uniprot_dict, sequence_length_dict = read_uniprot_sequences(uniprot_sequence_with_isoform)
+    ensp_to_sequence_digest_dict, unmatched_ensp_to_sequence_dict = read_ensembl_sequences(ensembl_fasta, sequence_to_uniprot_dict)
+    one_substitution_index = OneSubstitutionIndex(sequence_length_dict)
+
     # get uniprot from biomart and generate a map
-    biomart_ensp_to_uniprot_dict = dict()
-    get_uniprot_from_biomart(df_transcript, biomart_ensp_to_uniprot_dict, genome_build)
-    
+    biomart_store = BiomartUniprotStore(BIOMART_STORE_FILE.format(genome_build_version))
+    biomart_ensp_to_uniprot_dict = get_uniprot_from_biomart(df_transcript['ensp_id'], biomart_store, genome_build,
+                                                            concurrency=biomart_concurrency)
+    biomart_store.close()
 
-    # get reviewed mapping(previous mapping), generate reviewed_mapping_dict
+    # get reviewed mapping(previous mapping), the first mapping of every ensp
     reviewed_map = '../data/uniprot/input/reviewed_map_' + genome_build.lower() + '.tsv'
     df_reviewed_map = pd.read_csv(reviewed_map, sep='\t')
-    reviewed_mapping_dict = dict()
-    df_reviewed_map.apply(lambda row: generate_dict(row['ensp_id'], row['Final_mapping_uniprot_id'], reviewed_mapping_dict), axis=1)
-    
-    # 
-    df_transcript['biomart_uniprot_id'] = df_transcript.apply(lambda row: generate_biomart_uniprot(row['ensp_id'], biomart_ensp_to_uniprot_dict), axis = 1)
-    df_transcript['uniprot_id_with_isoform'] = df_transcript.apply(lambda row: get_uniprot_id_with_isoform(row['ensp_id'], ensp_to_sequence_dict, sequence_to_uniprot_dict), axis = 1)
-    df_transcript['is_matched'] = df_transcript.apply(lambda row: is_matched(row['uniprot_id_with_isoform'], row['biomart_uniprot_id']), axis = 1)
-    df_transcript['final_uniprot_id'] = df_transcript.apply(lambda row: curation(row['uniprot_id_with_isoform'], row['biomart_uniprot_id'], row['ensp_id'], ensp_to_sequence_dict, reviewed_mapping_dict, sequence_length_dict, sequence_to_uniprot_dict), axis = 1)
+    reviewed_mapping = df_reviewed_map.drop_duplicates('ensp_id').set_index('ensp_id')['Final_mapping_uniprot_id']
+
+    df_transcript['biomart_uniprot_id'] = df_transcript['ensp_id'].map(biomart_ensp_to_uniprot_dict).fillna('')
+    df_transcript['uniprot_id_with_isoform'] = get_uniprot_ids_with_isoform(df_transcript['ensp_id'], ensp_to_sequence_digest_dict, sequence_to_uniprot_dict)
+    df_transcript['is_matched'] = get_is_matched(df_transcript['uniprot_id_with_isoform'], df_transcript['biomart_uniprot_id'])
+    df_transcript['final_uniprot_id'] = curation(df_transcript, unmatched_ensp_to_sequence_dict, reviewed_mapping, one_substitution_index, sequence_to_uniprot_dict)
 
     # summary
     total_transcripts = np.count_nonzero(df_transcript['enst_id'])
@@ -268,5 +367,8 @@ if __name__ == "__main__":
                         help="../data/uniprot/input/uniprot_reviewed.fasta")
     parser.add_argument("genome_build_version",
                         help="grch37_ensembl92 or grch38_ensembl92 or grch38_ensembl95")
+    parser.add_argument("-c", "--biomart_concurrency", type=int, default=BIOMART_CONCURRENCY,
+                        help="number of BioMart queries sent at the same time")
     args = parser.parse_args()
-    main(args.ensembl_biomart_transcripts, args.ensembl_fasta, args.uniprot_sequence_with_isoform, args.genome_build_version)
+    main(args.ensembl_biomart_transcripts, args.ensembl_fasta, args.uniprot_sequence_with_isoform, args.genome_build_version,
+         args.biomart_concurrency)
@@ -0,0 +1,46 @@
+"""Streaming reader for FASTA files, e.g. the Ensembl peptide and UniProt sequence files.
+
+Records are read one at a time, so a whole file is never held in memory unless the caller keeps
+the sequences. Files with a .gz extension are decompressed on the fly.
+"""
+
+import gzip
+
+
+def open_fasta(fasta_file_name):
+    if str(fasta_file_name).endswith('.gz'):
+        return gzip.open(fasta_file_name, 'rt')
+    return open(fasta_file_name)
+
+
+def read_fasta(fasta_file_name):
+    """Yield a (header, sequence) tuple for every record in a FASTA file. The header is the
+    description line without '>', the sequence lines are joined without whitespace."""
+    with open_fasta(fasta_file_name) as fasta_file:
+        header = None
+        sequence_lines = []
+        for line in fasta_file:
+            if line.startswith('>'):
+                if header is not None:
+                    yield header, ''.join(sequence_lines)
+                header = line[1:].rstrip()
+                sequence_lines = []
+            else:
+                sequence_lines.append(line.strip())
+        if header is not None:
+            yield header, ''.join(sequence_lines)
+
+
+def get_record_id(header):
+    """Return the id of a record, the first word of its header like Biopython's record.id"""
+    return header.split(None, 1)[0] if header else ''
+
+
+def get_header_field(header, key):
+    """Return the value of a key:value field in a FASTA header (e.g. transcript in Ensembl
+    peptide headers), or None if the header does not have it"""
+    prefix = key + ':'
+    for field in header.split():
+        if field.startswith(prefix):
+            return field[len(prefix):]
+    return None
@@ -6,47 +6,70 @@ import pandas as pd
 import numpy as np
 import sys
 import re
+import functools
 import hgvs.parser
 PARSER = hgvs.parser.Parser()
 
-def count_variant_types(row):
-    MISSENSE_INDEX = 0
-    TRUNC_INDEX = 1
-    # FS_INDEX = 2
-    INFRAME_INDEX = 2
-    SPLICE_INDEX = 3
-    TOTAL_INDEX = 4
-    INDEX_NAMES = "missense trunc inframe splice total".split()
-    rv = [0, 0, 0, 0, 0]
-    
-    if row.type == "3d":
-        # ignore 3d hotspot
-        return pd.Series([np.nan]*len(INDEX_NAMES), index=INDEX_NAMES)
-
-    for v in row.variant_amino_acid.split("|"):
-        # add total
-        rv[TOTAL_INDEX] += int(v.split(":")[1])
-        
-        if "*" in v:
-            rv[TRUNC_INDEX] += int(v.split(":")[1])
-        elif "sp" in v:
-            rv[SPLICE_INDEX] += int(v.split(":")[1])
-        else:
-            # parse hgvs to get protein change length (can always use TP53, don't care about which protein)
-            if row.type == "in-frame indel":
-                sv = PARSER.parse_hgvs_variant("TP53:p.{}".format(v.split(":")[0]))
-            elif row.type == "single residue":
-                sv = PARSER.parse_hgvs_variant("TP53:p.{}{}".format(row.residue, v.split(":")[0]))
-            else:
-                raise(Exception("unknown Type: {}".format(row.type)))
-        
-            if sv.posedit.pos.start == sv.posedit.pos.end and sv.posedit.length_change() == 0:
-                rv[MISSENSE_INDEX] += int(v.split(":")[1])
-            else:
-                rv[INFRAME_INDEX] += int(v.split(":")[1])
-        
-    return pd.Series(rv, index=INDEX_NAMES)
-
+INDEX_NAMES = "missense trunc inframe splice total".split()
+
+# a single residue with a one letter amino acid as variant is a simple substitution, always missense
+SUBSTITUTION_RESIDUE = re.compile('[ACDEFGHIKLMNPQRSTVWY][0-9]+$')
+SUBSTITUTION_VARIANT = re.compile('[ACDEFGHIKLMNPQRSTVWY]$')
+
+
+@functools.lru_cache(maxsize=None)
+def classify_variant(hotspot_type, residue, variant):
+    """Return the type of a variant amino acid of a 2d hotspot: missense, trunc, inframe or splice.
+    The same variants occur in many hotspots, so the results are memoized, and the hgvs parser is
+    only used for variants that are not a simple substitution."""
+    if "*" in variant:
+        return "trunc"
+    elif "sp" in variant:
+        return "splice"
+    if hotspot_type == "single residue" and SUBSTITUTION_RESIDUE.match(residue) and SUBSTITUTION_VARIANT.match(variant):
+        return "missense"
+
+    # parse hgvs to get protein change length (can always use TP53, don't care about which protein)
+    if hotspot_type == "in-frame indel":
+        sv = PARSER.parse_hgvs_variant("TP53:p.{}".format(variant))
+    elif hotspot_type == "single residue":
+        sv = PARSER.parse_hgvs_variant("TP53:p.{}{}".format(residue, variant))
+    else:
+        raise(Exception("unknown Type: {}".format(hotspot_type)))
+
+    if sv.posedit.pos.start == sv.posedit.pos.end and sv.posedit.length_change() == 0:
+        return "missense"
+    else:
+        return "inframe"
+
+
+def count_variant_types(hotspots):
+    """Count the variants per type for every hotspot. Returns a DataFrame with the INDEX_NAMES
+    columns and the index of hotspots, 3d hotspots are ignored and get NaN."""
+    positions = np.flatnonzero((hotspots.type != "3d").values)
+    hotspots_2d = hotspots.iloc[positions]
+    # one row per variant amino acid, e.g. A:34
+    variants = pd.DataFrame({'position': positions,
+                             'type': hotspots_2d.type.values,
+                             'residue': hotspots_2d.residue.values,
+                             'variant': hotspots_2d.variant_amino_acid.str.split("|").values}).explode('variant')
+    variant_and_count = variants.variant.str.split(":")
+    variants['variant'] = variant_and_count.str[0]
+    variants['count'] = variant_and_count.str[1].astype(int)
+    variants['variant_type'] = [classify_variant(hotspot_type, residue, variant) for hotspot_type, residue, variant
+                                in zip(variants.type, variants.residue, variants.variant)]
+
+    counts = variants.groupby(['position', 'variant_type'])['count'].sum().unstack(fill_value=0)
+    counts = counts.reindex(columns=INDEX_NAMES[:-1], fill_value=0)
+    counts['total'] = variants.groupby('position')['count'].sum()
+
+    h_counts = pd.DataFrame(np.nan, index=range(len(hotspots)), columns=INDEX_NAMES)
+    h_counts.iloc[positions] = counts.reindex(positions).values
+    if len(positions) == len(hotspots):
+        # without 3d hotspots there are no NaNs
+        h_counts = h_counts.astype(int)
+    h_counts.index = hotspots.index
+    return h_counts
 
 
 if __name__ == "__main__":
@@ -75,7 +98,7 @@ if __name__ == "__main__":
     hotspots = pd.concat([hotspots_2d, hotspots_3d])
     assert(len(hotspots) == len(hotspots_2d) + len(hotspots_3d))
 
-    h_counts = hotspots.apply(count_variant_types, axis=1)
+    h_counts = count_variant_types(hotspots)
     for c in h_counts.columns:
         hotspots[c + "_count"] = h_counts[c]
     for c in h_counts.columns[:-1]:
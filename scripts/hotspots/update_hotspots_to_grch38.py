@@ -19,15 +19,32 @@ Logs and outputs:
  - reports the total number of rows in original hotspots file, the number of rows replaced and the number of rows dropped
  - outputs a new updated combined 2d and 3d hotspot file (grch38)
 
+The sequences of all distinct transcript ids are fetched first, in batches with POST /sequence/id
+requests that are sent in parallel, so the rows are validated without a request per row.
+With --grch37_peptide_fasta and --grch38_peptide_fasta the sequences are read from the Ensembl
+peptide FASTA files instead (ftp.ensembl.org/pub/.../fasta/homo_sapiens/pep/), without network access.
+
 Links to used API docs: 
  - https://rest.ensembl.org/documentation/info/sequence_id
+ - https://rest.ensembl.org/documentation/info/sequence_id_post
  """
 
 
 import argparse
+import os
+import sys
+import threading
+import functools
+from concurrent.futures import ThreadPoolExecutor
 import requests
 import pandas as pd
 
+# shared modules are in the parent scripts folder
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+import http_cache
+from alias_index import AliasIndex
+import fasta_reader
+
 from requests.adapters import HTTPAdapter, Retry
 s = requests.Session()
 retries = Retry(total=5,
@@ -38,8 +55,16 @@ s.mount('https://', HTTPAdapter(max_retries=retries))
 ENSEMBL_GRCH38_SERVER = "https://rest.ensembl.org"
 ENSEMBL_GRCH37_SERVER = "https://grch37.rest.ensembl.org"
 nr_ensembl_ws_calls = 1
+nr_ensembl_ws_calls_lock = threading.Lock()
+
+# Ensembl accepts at most 50 ids per POST /sequence/id request
+SEQUENCE_BATCH_SIZE = 50
+# Number of batch requests that are sent at the same time
+SEQUENCE_WORKERS = 4
 
 protein_sequence_cache = {}
+# servers whose sequences are all loaded from a peptide FASTA file, these are never queried
+offline_ensembl_servers = set()
 
 def get_translated_protein_sequence(ensembl_server: str, transcript_id: str) -> str:
     """ Returns the translated protein sequence for the given transcript id.
@@ -49,8 +74,11 @@ def get_translated_protein_sequence(ensembl_server: str, transcript_id: str) ->
     cache_key = "{0}_{1}".format(ensembl_server, transcript_id)
     if cache_key in protein_sequence_cache:
         return protein_sequence_cache[cache_key]
+    if ensembl_server in offline_ensembl_servers:
+        print("transcript id {0} is not found in the peptide FASTA of {1}".format(transcript_id, ensembl_server))
+        return None
     api_url = "{0}/sequence/id/{1}?type=protein".format(ensembl_server, transcript_id) 
-    response = s.get(api_url, headers={ "Content-Type" : "text/plain"}, timeout=2)
+    response = http_cache.request('GET', api_url, session=s, headers={ "Content-Type" : "text/plain"}, timeout=2)
     nr_ensembl_ws_calls += 1
     print("=-------------Nr ws calls {0}. Response code {1}".format(nr_ensembl_ws_calls, response.status_code))
     if not response.ok:
@@ -63,6 +91,65 @@ def get_translated_protein_sequence(ensembl_server: str, transcript_id: str) ->
     return response.text
 
 
+def request_translated_protein_sequences(ensembl_server: str, transcript_ids: list) -> dict:
+    """ Returns the translated protein sequences of a batch of transcript ids, fetched with one
+        POST request, as a map of transcript id X sequence. Transcript ids that are not found are
+        left out, and the whole batch is left out if the webservice failed with a 400 type code.
+    """
+    global nr_ensembl_ws_calls
+    api_url = "{0}/sequence/id?type=protein".format(ensembl_server)
+    response = http_cache.request('POST', api_url, session=s, json={"ids": transcript_ids},
+                                  headers={"Content-Type": "application/json", "Accept": "application/json"}, timeout=60)
+    with nr_ensembl_ws_calls_lock:
+        nr_ensembl_ws_calls += 1
+        print("=-------------Nr ws calls {0}. Response code {1} for {2} transcript ids".format(nr_ensembl_ws_calls, response.status_code, len(transcript_ids)))
+    if not response.ok:
+        if response.status_code >= 400 and response.status_code < 500:
+            print("batch of {0} transcript ids is not found on {1}".format(len(transcript_ids), ensembl_server))
+            return {}
+        else:
+            response.raise_for_status()
+    # query is the requested id, id can be the id of the translation
+    return {sequence.get('query', sequence['id']): sequence['seq'] for sequence in response.json()}
+
+
+def get_translated_protein_sequences(ensembl_server: str, transcript_ids: list,
+                                     batch_size: int = SEQUENCE_BATCH_SIZE, workers: int = SEQUENCE_WORKERS) -> dict:
+    """ Fetches the translated protein sequences of all transcript ids that are not cached yet,
+        in batches of batch_size with at most workers requests at the same time, and adds them to
+        the cache. Returns a map of transcript id X sequence for the transcript ids that are found.
+        Transcript ids that are not found are not cached, get_translated_protein_sequence
+        retries them one by one.
+    """
+    transcript_ids = sorted(set(transcript_ids))
+    missing_transcript_ids = [transcript_id for transcript_id in transcript_ids
+                              if "{0}_{1}".format(ensembl_server, transcript_id) not in protein_sequence_cache
+                              and ensembl_server not in offline_ensembl_servers]
+    batches = [missing_transcript_ids[i:i + batch_size] for i in range(0, len(missing_transcript_ids), batch_size)]
+    with ThreadPoolExecutor(workers) as pool:
+        for sequences in pool.map(functools.partial(request_translated_protein_sequences, ensembl_server), batches):
+            for transcript_id, sequence in sequences.items():
+                protein_sequence_cache["{0}_{1}".format(ensembl_server, transcript_id)] = sequence
+    return {transcript_id: protein_sequence_cache["{0}_{1}".format(ensembl_server, transcript_id)]
+            for transcript_id in transcript_ids
+            if "{0}_{1}".format(ensembl_server, transcript_id) in protein_sequence_cache}
+
+
+def load_peptide_fasta(ensembl_server: str, peptide_fasta_file_name: str) -> None:
+    """ Loads the protein sequences of an Ensembl peptide FASTA file (e.g. Homo_sapiens.GRCh38.pep.all.fa.gz)
+        into the cache, by transcript id without version. Afterwards the sequences of ensembl_server are
+        only looked up in the cache, transcripts that are not in the file are treated as not found.
+    """
+    nr_sequences = 0
+    for header, sequence in fasta_reader.read_fasta(peptide_fasta_file_name):
+        transcript_id = fasta_reader.get_header_field(header, 'transcript')
+        if transcript_id is not None:
+            protein_sequence_cache["{0}_{1}".format(ensembl_server, transcript_id.split('.')[0])] = sequence
+            nr_sequences += 1
+    offline_ensembl_servers.add(ensembl_server)
+    print("Loaded {0} sequences for {1} from {2}".format(nr_sequences, ensembl_server, peptide_fasta_file_name))
+
+
 def get_gene_and_transcript_map(hugo_and_transcript_id_file_name: str) -> dict:
     """ Returns a map of hugo symbol X canonical transcript id.
     """
@@ -87,32 +174,36 @@ def new_transcript_id_is_valid(grch37_transcript_id: str,
     return grch37_sequence == grch38_sequence
 
 
-def get_new_hugo_symbol(old_hugo_symbol: str, hugo_and_transcript_map: str) -> str:
+def get_alias_index(hugo_and_transcript_map: dict) -> AliasIndex:
+    """Returns an index from the hugo symbols in the map and their "previous_symbols" and "synonyms"
+       to the hugo symbol.
+    """
+    hugo_and_transcript_df = pd.DataFrame.from_dict(hugo_and_transcript_map, orient='index')
+    return AliasIndex.from_table(hugo_and_transcript_df, ['previous_symbols', 'synonyms'], separator=',')
+
+
+def get_new_hugo_symbol(old_hugo_symbol: str, hugo_and_transcript_map: dict, alias_index: AliasIndex = None) -> str:
     """Looks for the give old_hugo_symbol in  "previous_symbols" or "synonyms" columns of the map values
        and when found, returns the corresponding key (the new hugo_symbol). If not found, returns None.
+       alias_index is built from the map when it is not given.
     """
-    for new_hugo_symbol, other_columns in hugo_and_transcript_map.items():
-        if type(other_columns['previous_symbols']) == str:
-            previous_symbols = [x.strip() for x in other_columns['previous_symbols'].split(',')]
-            if old_hugo_symbol in previous_symbols:
-                print("found {0} in 'previous_symbols".format(old_hugo_symbol))
-                return new_hugo_symbol
-        if type(other_columns['synonyms']) == str:
-            synonyms = [x.strip() for x in other_columns['synonyms'].split(',')]
-            if old_hugo_symbol in synonyms:
-                print("found {0} in 'synonyms".format(old_hugo_symbol))
-                return new_hugo_symbol
-    return None
-
-
-def find_grch38_transcript_id(hugo_symbol: str, hugo_and_transcript_map: dict, grch38_isoform_override_source: str) -> str:
+    if alias_index is None:
+        alias_index = get_alias_index(hugo_and_transcript_map)
+    new_hugo_symbol = alias_index.aliases.get(old_hugo_symbol)
+    if new_hugo_symbol is not None:
+        print("found {0} in 'previous_symbols' or 'synonyms' of {1}".format(old_hugo_symbol, new_hugo_symbol))
+    return new_hugo_symbol
+
+
+def find_grch38_transcript_id(hugo_symbol: str, hugo_and_transcript_map: dict, grch38_isoform_override_source: str,
+                              alias_index: AliasIndex = None) -> str:
     """Tries to find the hugo symbol in the map's index or in the alias column. If found,
        returns the respective transcript id according to grch38_isoform_override_source.
        If not found, returns None.
     """
     if hugo_symbol not in hugo_and_transcript_map:
         # then try to find the row that has this symbol as one of the values in "previous_symbols" or "synonyms"
-        hugo_symbol = get_new_hugo_symbol(hugo_symbol, hugo_and_transcript_map)
+        hugo_symbol = get_new_hugo_symbol(hugo_symbol, hugo_and_transcript_map, alias_index)
         if hugo_symbol is None:
             return None
           
@@ -121,26 +212,54 @@ def find_grch38_transcript_id(hugo_symbol: str, hugo_and_transcript_map: dict, g
 
 def generate_updated_grch38_hotspots_info(grch38_hugo_and_transcript_id_file_name: str,
                                           grch38_isoform_override_source: str,
-                                          grch37_hotspots_2d_3d_file_name: str) -> None:
+                                          grch37_hotspots_2d_3d_file_name: str,
+                                          alias_index_file_name: str = None,
+                                          batch_size: int = SEQUENCE_BATCH_SIZE,
+                                          workers: int = SEQUENCE_WORKERS,
+                                          grch37_peptide_fasta_file_name: str = None,
+                                          grch38_peptide_fasta_file_name: str = None) -> None:
+    # with peptide FASTA files the sequences are compared offline
+    if grch37_peptide_fasta_file_name is not None:
+        load_peptide_fasta(ENSEMBL_GRCH37_SERVER, grch37_peptide_fasta_file_name)
+    if grch38_peptide_fasta_file_name is not None:
+        load_peptide_fasta(ENSEMBL_GRCH38_SERVER, grch38_peptide_fasta_file_name)
     hugo_and_transcript_map = get_gene_and_transcript_map(grch38_hugo_and_transcript_id_file_name)
+    # the alias index is saved to alias_index_file_name, and loaded from it in later runs
+    if alias_index_file_name is not None and os.path.exists(alias_index_file_name):
+        alias_index = AliasIndex.load(alias_index_file_name)
+    else:
+        alias_index = get_alias_index(hugo_and_transcript_map)
+        if alias_index_file_name is not None:
+            alias_index.save(alias_index_file_name)
     grch37_hotspots_df = pd.read_csv(grch37_hotspots_2d_3d_file_name, sep='\t', dtype=str)
-    
+
+    # find the proposed grch38 transcript id of every row first:
+    proposed_grch38_transcript_ids = [find_grch38_transcript_id(hugo_symbol, hugo_and_transcript_map, grch38_isoform_override_source, alias_index)
+                                      for hugo_symbol in grch37_hotspots_df['hugo_symbol']]
+    if batch_size > 0:
+        # then fetch all distinct sequences in batches, so the rows are validated from the cache
+        rows_with_proposal = [(grch37_transcript_id, grch38_transcript_id)
+                              for grch37_transcript_id, grch38_transcript_id in zip(grch37_hotspots_df['transcript_id'], proposed_grch38_transcript_ids)
+                              if isinstance(grch37_transcript_id, str) and isinstance(grch38_transcript_id, str)]
+        get_translated_protein_sequences(ENSEMBL_GRCH37_SERVER, [ids[0] for ids in rows_with_proposal], batch_size, workers)
+        get_translated_protein_sequences(ENSEMBL_GRCH38_SERVER, [ids[1] for ids in rows_with_proposal], batch_size, workers)
+
     rows_to_drop = []
     nr_updated_rows = 0
     # iterate over the rows and replace with new transcript_id if valid:
-    for index, row in grch37_hotspots_df.iterrows():
-        hugo_symbol = row['hugo_symbol']
+    for index, hugo_symbol, grch37_transcript_id, proposed_grch38_transcript_id in zip(grch37_hotspots_df.index,
+                                                                                     grch37_hotspots_df['hugo_symbol'],
+                                                                                     grch37_hotspots_df['transcript_id'],
+                                                                                     proposed_grch38_transcript_ids):
         print("Processing {0} ...".format(hugo_symbol))
-        grch37_transcript_id = row['transcript_id']
-        proposed_grch38_transcript_id = find_grch38_transcript_id(hugo_symbol, hugo_and_transcript_map, grch38_isoform_override_source)
         is_valid = proposed_grch38_transcript_id is not None and \
                    new_transcript_id_is_valid(grch37_transcript_id,
                                               proposed_grch38_transcript_id)
         # if valid, replace transcript_id:
         if is_valid:
-            if row['transcript_id'] != proposed_grch38_transcript_id:
-                print('Updating transcript of {0} from {1} to {2}'.format(hugo_symbol, row['transcript_id'], proposed_grch38_transcript_id))
-                row['transcript_id'] = proposed_grch38_transcript_id
+            if grch37_transcript_id != proposed_grch38_transcript_id:
+                print('Updating transcript of {0} from {1} to {2}'.format(hugo_symbol, grch37_transcript_id, proposed_grch38_transcript_id))
+                grch37_hotspots_df.at[index, 'transcript_id'] = proposed_grch38_transcript_id
                 nr_updated_rows += 1
         else:
             # mark for dropping any row where new transcript_id is not valid:
@@ -166,11 +285,26 @@ if __name__ == "__main__":
                         type=str, help="which transcript override source is preferred. Possible values: [mskcc, uniprot, genome_nexus, ensembl]")
     parser.add_argument("--grch37_hotspots_2d_3d_file_name", default="../../data/grch37_ensembl92/export/hotspots_v2_and_3d.txt",
                         type=str, help="combined grch37 2D and 3D cancerhotspots data file")
+    parser.add_argument("--alias_index_file_name", default=None,
+                        type=str, help="JSON file with the index of previous symbols and synonyms. Created if it does not exist")
+    parser.add_argument("--batch_size", default=SEQUENCE_BATCH_SIZE,
+                        type=int, help="number of transcript ids per sequence request. 0 fetches the sequences one by one")
+    parser.add_argument("--workers", default=SEQUENCE_WORKERS,
+                        type=int, help="number of sequence requests that are sent at the same time")
+    parser.add_argument("--grch37_peptide_fasta", default=None,
+                        type=str, help="Ensembl grch37 peptide FASTA file, e.g. Homo_sapiens.GRCh37.pep.all.fa.gz. Used instead of the grch37 REST API")
+    parser.add_argument("--grch38_peptide_fasta", default=None,
+                        type=str, help="Ensembl grch38 peptide FASTA file, e.g. Homo_sapiens.GRCh38.pep.all.fa.gz. Used instead of the grch38 REST API")
     args = parser.parse_args()
 
     grch37_hotspots_df = generate_updated_grch38_hotspots_info(args.grch38_hugo_and_transcript_id_file_name,
                                                                args.grch38_isoform_override_source,
-                                                               args.grch37_hotspots_2d_3d_file_name)
+                                                               args.grch37_hotspots_2d_3d_file_name,
+                                                               args.alias_index_file_name,
+                                                               args.batch_size,
+                                                               args.workers,
+                                                               args.grch37_peptide_fasta,
+                                                               args.grch38_peptide_fasta)
     output_file_name = args.grch37_hotspots_2d_3d_file_name + "_grch38_ported.txt"
     grch37_hotspots_df.to_csv(output_file_name, sep='\t', index=False)
     print('Output written to: {0}'.format(output_file_name))
\ No newline at end of file
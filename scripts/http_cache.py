@@ -0,0 +1,163 @@
+"""Persistent on-disk cache for the responses of the remote services used by the pipeline
+(Ensembl REST, BioMart, OncoKB).
+
+Responses are stored in a SQLite database, keyed by a hash of the request method, URL, body and
+Accept/Content-Type headers, so re-running a failed step or building another genome version
+reuses earlier responses instead of querying the service again. Only successful responses are
+cached. Entries expire after a time to live, and the least recently used entries are evicted
+when the cache grows beyond its maximum size.
+
+The cache is off by default, so a build always fetches current data. It is meant to resume a
+failed run or to share responses between the grch37 and grch38 builds, and every response that is
+served from the cache is logged to stderr. It is configured with environment variables, so every
+script picks it up without extra arguments (e.g. make HTTP_CACHE_FILE=$PWD/http_cache.sqlite):
+ - HTTP_CACHE_FILE: path of the cache database. Caching is disabled when it is not set.
+ - HTTP_CACHE_TTL_DAYS: days before a cached response expires (default 30).
+ - HTTP_CACHE_MAX_SIZE_MB: maximum size of all cached responses (default 2048).
+ - HTTP_CACHE_OFFLINE: when set to 1, never use the network. A request that is not in the cache
+   raises CacheMissError, e.g. to run the scripts in CI without network access.
+"""
+
+import os
+import sys
+import time
+import sqlite3
+import hashlib
+import threading
+import requests
+from requests.structures import CaseInsensitiveDict
+
+DEFAULT_TTL_DAYS = 30
+DEFAULT_MAX_SIZE_MB = 2048
+
+# Request headers that change the response format, and are therefore part of the cache key
+KEY_HEADERS = ['Accept', 'Content-Type']
+
+
+class CacheMissError(requests.exceptions.RequestException):
+    """Raised in offline mode for a request that is not in the cache. It is not a ConnectionError,
+    so callers that retry connection errors fail at once instead of retrying."""
+
+
+class ResponseCache:
+    """Content-addressed response cache with a time to live and LRU eviction, in a SQLite database"""
+
+    def __init__(self, file_name, ttl_days=DEFAULT_TTL_DAYS, max_size_mb=DEFAULT_MAX_SIZE_MB, offline=False):
+        self.ttl = ttl_days * 24 * 3600
+        self.max_size = max_size_mb * 1024 * 1024
+        self.offline = offline
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(file_name, check_same_thread=False)
+        with self.lock, self.connection:
+            self.connection.execute('CREATE TABLE IF NOT EXISTS responses ('
+                                    'key TEXT PRIMARY KEY, '
+                                    'url TEXT, '
+                                    'status_code INTEGER, '
+                                    'content_type TEXT, '
+                                    'content BLOB, '
+                                    'size INTEGER, '
+                                    'created REAL, '
+                                    'last_access REAL)')
+            self.connection.execute('CREATE INDEX IF NOT EXISTS responses_last_access ON responses (last_access)')
+
+    @staticmethod
+    def get_key(prepared_request):
+        body = prepared_request.body or b''
+        if isinstance(body, str):
+            body = body.encode()
+        headers = '\n'.join('%s: %s' % (header, prepared_request.headers.get(header, ''))
+                            for header in KEY_HEADERS)
+        key_data = '%s %s\n%s\n' % (prepared_request.method, prepared_request.url, headers)
+        return hashlib.sha256(key_data.encode() + body).hexdigest()
+
+    def get(self, key):
+        """Return the cached response for key as a requests.Response, or None if it is absent or expired"""
+        now = time.time()
+        with self.lock, self.connection:
+            row = self.connection.execute('SELECT url, status_code, content_type, content, created FROM responses '
+                                          'WHERE key = ? AND created > ?', (key, now - self.ttl)).fetchone()
+            if row is None:
+                return None
+            self.connection.execute('UPDATE responses SET last_access = ? WHERE key = ?', (now, key))
+        url, status_code, content_type, content, created = row
+        response = requests.Response()
+        response.url = url
+        response.status_code = status_code
+        response.headers = CaseInsensitiveDict({'Content-Type': content_type} if content_type else {})
+        response._content = content
+        response.cached_at = created
+        response.encoding = requests.utils.get_encoding_from_headers(response.headers) or 'utf-8'
+        return response
+
+    def put(self, key, response):
+        now = time.time()
+        content = response.content
+        with self.lock, self.connection:
+            self.connection.execute('INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                                    (key, response.url, response.status_code, response.headers.get('Content-Type'),
+                                     content, len(content), now, now))
+            self.evict(now)
+
+    def evict(self, now):
+        """Remove expired entries, then the least recently used entries until the cache fits in its maximum size"""
+        self.connection.execute('DELETE FROM responses WHERE created <= ?', (now - self.ttl,))
+        total_size = self.connection.execute('SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0]
+        if total_size <= self.max_size:
+            return
+        evicted_keys = []
+        for key, size in self.connection.execute('SELECT key, size FROM responses ORDER BY last_access'):
+            if total_size <= self.max_size:
+                break
+            evicted_keys.append((key,))
+            total_size -= size
+        self.connection.executemany('DELETE FROM responses WHERE key = ?', evicted_keys)
+
+    def close(self):
+        self.connection.close()
+
+
+_default_cache = None
+_default_cache_lock = threading.Lock()
+
+
+def get_default_cache():
+    """Return the cache configured by the environment variables, or None if caching is disabled"""
+    global _default_cache
+    file_name = os.environ.get('HTTP_CACHE_FILE')
+    if not file_name:
+        return None
+    with _default_cache_lock:
+        if _default_cache is None:
+            _default_cache = ResponseCache(file_name,
+                                           ttl_days=float(os.environ.get('HTTP_CACHE_TTL_DAYS', DEFAULT_TTL_DAYS)),
+                                           max_size_mb=float(os.environ.get('HTTP_CACHE_MAX_SIZE_MB', DEFAULT_MAX_SIZE_MB)),
+                                           offline=os.environ.get('HTTP_CACHE_OFFLINE') == '1')
+    return _default_cache
+
+
+def request(method, url, session=None, cache=None, is_cacheable=None, **kwargs):
+    """Send an HTTP request like requests.request, answering it from the cache when possible.
+    Successful responses are stored in the cache, unless is_cacheable(response) returns False
+    (e.g. for services that report errors with status 200).
+    Without a configured cache this is the same as calling requests directly."""
+    if cache is None:
+        cache = get_default_cache()
+    sender = session if session is not None else requests
+    if cache is None:
+        return sender.request(method, url, **kwargs)
+
+    request_kwargs = {name: kwargs.pop(name) for name in ['params', 'data', 'json', 'headers'] if name in kwargs}
+    prepared_request = requests.Request(method, url, **request_kwargs).prepare()
+    key = cache.get_key(prepared_request)
+    response = cache.get(key)
+    if response is not None:
+        sys.stderr.write('Using cached response from %s for %s %s\n' % (
+            time.strftime('%Y-%m-%d %H:%M', time.localtime(response.cached_at)), method, prepared_request.url))
+        return response
+    if cache.offline:
+        raise CacheMissError('%s %s is not in the HTTP cache (offline mode)' % (method, prepared_request.url))
+
+    response = sender.request(method, url, **request_kwargs, **kwargs)
+    if response.ok and (is_cacheable is None or is_cacheable(response)):
+        cache.put(key, response)
+    return response
@@ -0,0 +1,153 @@
+"""Read and write the intermediate tables that are passed between the pipeline steps in tmp/.
+
+Tables are stored as TSV by default. When the file name ends with .parquet, the table is stored
+as Parquet with an explicit schema instead, so the next step can load the columns directly
+without parsing text or inferring types. Parquet support needs pyarrow, which is only imported
+when a .parquet file is used.
+
+The schemas use the types that type inference gives for the TSV files of a full Ensembl release,
+so the JSON and TSV exports do not change when the intermediate format changes. Columns that
+are always filled in a full release but may be empty on other input, like strand, use the
+nullable Int64 type, so the Parquet output accepts every row that the TSV output accepts.
+"""
+
+import numpy as np
+import pandas as pd
+
+PARQUET_EXTENSION = '.parquet'
+
+# Parquet column type for each pandas type used in the schemas below
+ARROW_TYPES = {'object': 'string', 'int64': 'int64', 'Int64': 'int64', 'float64': 'float64'}
+
+# tmp/ensembl_transcript_info.txt, written by transform_gff_to_tsv_for_exon_info_from_ensembl.py
+TRANSCRIPT_INFO_SCHEMA = {
+    'transcript_id': 'object',
+    'type': 'object',
+    'id': 'object',
+    'start': 'int64',
+    'end': 'int64',
+    'rank': 'float64',
+    # empty when the GFF3 strand is '.'
+    'strand': 'Int64',
+    'version': 'float64',
+}
+
+# tmp/ensembl_canonical_data.txt, written by download_transcript_info_from_ensembl.py
+CANONICAL_DATA_SCHEMA = {
+    'gene_stable_id': 'object',
+    'transcript_stable_id': 'object',
+    'hgnc_symbol': 'object',
+    'hgnc_id': 'object',
+    'is_canonical': 'int64',
+    'protein_stable_id': 'object',
+    'protein_length': 'float64',
+}
+
+# tmp/ensembl_biomart_transcripts.txt, derived from ensembl_canonical_data.txt in the Makefile
+BIOMART_TRANSCRIPTS_SCHEMA = {
+    'transcript_stable_id': 'object',
+    'gene_stable_id': 'object',
+    'hgnc_symbol': 'object',
+    'protein_stable_id': 'object',
+    'protein_length': 'float64',
+}
+
+
+def is_parquet(file_name):
+    return str(file_name).endswith(PARQUET_EXTENSION)
+
+
+def apply_schema(df, schema):
+    """Cast the columns of df that are in schema to their schema type. Empty strings in
+    non-string columns become NaN first, the same as when reading a TSV file."""
+    df = df.copy()
+    for column, dtype in schema.items():
+        if column not in df.columns:
+            continue
+        values = df[column].where(df[column] != '', np.nan)
+        if dtype == 'object':
+            df[column] = values.astype(object)
+        else:
+            df[column] = pd.to_numeric(values).astype(dtype)
+    return df
+
+
+def to_arrow_table(df, schema):
+    """Convert df to a pyarrow Table with the column types of schema"""
+    import pyarrow as pa
+    arrow_schema = pa.schema([(column, getattr(pa, ARROW_TYPES[dtype])()) for column, dtype in schema.items()])
+    return pa.Table.from_pandas(apply_schema(df[list(schema)], schema), schema=arrow_schema, preserve_index=False)
+
+
+def read_table(file_name, dtype=None, index_col=None, **read_csv_kwargs):
+    """Read an intermediate table. TSV files are read with pd.read_csv and the given arguments.
+    Parquet files already have their types, dtype is only applied on top of them to the values
+    that are not missing, so missing values stay NaN like read_csv leaves them. index_col (a
+    column position or name) is set as index like read_csv would."""
+    if not is_parquet(file_name):
+        return pd.read_csv(file_name, sep='\t', dtype=dtype, index_col=index_col, **read_csv_kwargs)
+
+    df = pd.read_parquet(file_name, columns=read_csv_kwargs.get('usecols'))
+    if dtype is not None:
+        df = df.astype(dtype).where(df.notnull())
+    if index_col is not None:
+        if isinstance(index_col, int):
+            index_col = df.columns[index_col]
+        df = df.set_index(index_col)
+    return df
+
+
+def write_table(df, file_name, schema):
+    """Write an intermediate table, as Parquet with the columns and types of schema or as TSV"""
+    if is_parquet(file_name):
+        import pyarrow.parquet as pq
+        pq.write_table(to_arrow_table(df, schema), file_name)
+    else:
+        df.to_csv(file_name, sep='\t', index=False)
+
+
+class ParquetChunkWriter:
+    """Writes a table to a Parquet file chunk by chunk, for steps that stream their output.
+    Each chunk is a list of rows in the order of the schema columns."""
+
+    def __init__(self, file_name, schema):
+        import pyarrow.parquet as pq
+        self.schema = schema
+        self.writer = None
+        self.file_name = file_name
+        self.pq = pq
+
+    def writerows(self, rows):
+        chunk_df = pd.DataFrame(rows, columns=list(self.schema), dtype=object)
+        table = to_arrow_table(chunk_df, self.schema)
+        if self.writer is None:
+            self.writer = self.pq.ParquetWriter(self.file_name, table.schema)
+        self.writer.write_table(table)
+
+    def close(self):
+        if self.writer is None:
+            # no rows were written, still create a file with the schema
+            self.writer = self.pq.ParquetWriter(self.file_name, to_arrow_table(pd.DataFrame(columns=list(self.schema)), self.schema).schema)
+        self.writer.close()
+
+
+SCHEMAS = {
+    'transcript_info': TRANSCRIPT_INFO_SCHEMA,
+    'canonical_data': CANONICAL_DATA_SCHEMA,
+    'biomart_transcripts': BIOMART_TRANSCRIPTS_SCHEMA,
+}
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Convert an intermediate TSV table to Parquet")
+    parser.add_argument("schema", choices=sorted(SCHEMAS),
+                        help="which intermediate table is converted")
+    parser.add_argument("tsv_file",
+                        help="e.g. tmp/ensembl_biomart_transcripts.txt")
+    parser.add_argument("parquet_file",
+                        help="e.g. tmp/ensembl_biomart_transcripts.parquet")
+    args = parser.parse_args()
+
+    schema = SCHEMAS[args.schema]
+    write_table(pd.read_csv(args.tsv_file, sep='\t', dtype=object, keep_default_na=False), args.parquet_file, schema)
@@ -0,0 +1,103 @@
+"""Write a table as JSON lines one record at a time, instead of building the whole JSON
+string in memory like DataFrame.to_json does.
+
+The output is the same as DataFrame.to_json(orient='records', lines=True) for the values in the
+pipeline tables: NaN becomes null, nested DataFrames become lists of records and forward slashes
+are escaped. Gzipped output can be compressed in several threads. The blocks are then written as
+consecutive gzip members, which gunzip and Python's gzip module read as one file.
+"""
+
+import gzip
+import json
+import collections
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import pandas as pd
+
+# Size of the uncompressed text blocks that are compressed in parallel
+BLOCK_SIZE = 4 * 1024 * 1024
+
+json_encoder = json.JSONEncoder(separators=(',', ':'))
+
+
+def to_json_value(value):
+    """Convert a cell value to plain Python objects that the JSON encoder writes like pandas"""
+    # exact type checks first, they cover nearly all nested values
+    value_type = type(value)
+    if value_type is str or value_type is int:
+        return value
+    if value_type is float:
+        return None if value != value else value
+    if value_type is dict:
+        return {key: to_json_value(item) for key, item in value.items()}
+    if value_type is list:
+        return [to_json_value(item) for item in value]
+    if isinstance(value, float):
+        return None if value != value else value
+    if isinstance(value, tuple):
+        return [to_json_value(item) for item in value]
+    if isinstance(value, pd.DataFrame):
+        return to_json_value(value.to_dict(orient='records'))
+    if isinstance(value, np.generic):
+        return to_json_value(value.item())
+    if value is pd.NA:
+        return None
+    return value
+
+
+def iter_column_values(column):
+    """Iterate over the values of a column as plain Python objects. Nested values are only
+    converted when their row is written."""
+    if column.dtype != object:
+        return iter(column.astype(object).where(column.notnull(), None).tolist())
+    return map(to_json_value, column.tolist())
+
+
+def iter_json_lines(df):
+    """Yield one JSON line per row of df. The index is not written."""
+    columns = list(df.columns)
+    for values in zip(*[iter_column_values(df[column]) for column in columns]):
+        # pandas escapes forward slashes, do the same so the output does not change
+        yield json_encoder.encode(dict(zip(columns, values))).replace('/', '\\/') + '\n'
+
+
+def iter_blocks(lines, block_size):
+    """Join lines into encoded blocks of at least block_size characters"""
+    block = []
+    size = 0
+    for line in lines:
+        block.append(line)
+        size += len(line)
+        if size >= block_size:
+            yield ''.join(block).encode()
+            block = []
+            size = 0
+    if block:
+        yield ''.join(block).encode()
+
+
+def write_gzip_blocks(lines, file_name, threads, block_size=BLOCK_SIZE):
+    """Compress blocks of lines in a thread pool and write them in order. At most 2 blocks per
+    thread are in flight, to keep memory use bounded."""
+    with open(file_name, 'wb') as out_file, ThreadPoolExecutor(threads) as pool:
+        pending = collections.deque()
+        for block in iter_blocks(lines, block_size):
+            pending.append(pool.submit(gzip.compress, block))
+            if len(pending) >= 2 * threads:
+                out_file.write(pending.popleft().result())
+        while pending:
+            out_file.write(pending.popleft().result())
+
+
+def write_json_lines(df, file_name, threads=1, block_size=BLOCK_SIZE):
+    """Write df as JSON lines to file_name, gzipped when the file name has a .gz extension.
+    With threads > 1 the output is compressed in that many threads."""
+    lines = iter_json_lines(df)
+    if '.gz' not in file_name:
+        with open(file_name, 'w') as out_file:
+            out_file.writelines(lines)
+    elif threads > 1:
+        write_gzip_blocks(lines, file_name, threads, block_size)
+    else:
+        with gzip.open(file_name, 'wt') as out_file:
+            out_file.writelines(lines)
@@ -4,10 +4,12 @@
 This mouse-specific script will determine the canonical transcript for each gene based on Ensembl 'is_canonical' annotation.
 If no unambiguous canonical transcript can be derived from the annotation, the longest protein will be used.
 Additionally, some dataframe reformatting is performed to resemble the human dataframe.
+The Ensembl transcript info (tmp/ensembl_canonical_data.txt) may also be a .parquet intermediate table.
 '''
 
 import pandas as pd
 import argparse
+import intermediate_format
 
 def load_MGI_data(ensembl_data, genemodel_data):
     """Loads MGI mouse data frames and combines relevant columns. 
@@ -38,7 +40,7 @@ def get_canonical_transcript_by_ensembl(transcript_info):
     Then for each symbol retrieves the first gene.
     """
 
-    transcripts = pd.read_csv(transcript_info, sep="\t", dtype=str)
+    transcripts = intermediate_format.read_table(transcript_info, dtype=str)
 
     canonical_transcripts = transcripts.sort_values(["is_canonical", "protein_length"], ascending=False)\
         .groupby("hgnc_symbol").head(1)
@@ -95,7 +97,7 @@ def main(transcript_info, ensembl_data, genemodel_data, canonical_transcripts_pe
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("transcript_info",
-                        help="tmp/ensembl_canonical_data.txt")
+                        help="tmp/ensembl_canonical_data.txt or .parquet")
     parser.add_argument("ensembl_data",
                         help="common_input/mouse/MRK_ENSEMBL.rpt")
     parser.add_argument("genemodel_data",
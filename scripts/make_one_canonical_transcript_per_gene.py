@@ -1,109 +1,72 @@
 #!/usr/bin/env python3
 import pandas as pd
-import numpy as np
-import itertools
 import argparse
+import intermediate_format
+from ensembl_canonical_index import EnsemblCanonicalIndex
+from alias_index import AliasIndex
+
+
+# columns of the output that are determined per hugo symbol, in output order
+CANONICAL_TRANSCRIPT_COLUMNS = """
+    ensembl_canonical_gene
+    ensembl_canonical_transcript
+    ensembl_canonical_transcript_explanation
+    genome_nexus_canonical_transcript
+    genome_nexus_canonical_transcript_explanation
+    uniprot_canonical_transcript
+    uniprot_canonical_transcript_explanation
+    mskcc_canonical_transcript
+    mskcc_canonical_transcript_explanation
+    """.split()
+
+
+def get_overrides_transcripts(hugos, overrides_tables, overrides_table_names, ensembl_canonical):
+    """Find canonical transcript id for all hugo symbols. Overrides_tables is a list of different
+    override tables, the first table with an override for a hugo symbol is used. Hugo symbols
+    without an override get the ensembl canonical transcript.
+    Returns the transcripts and their explanations, indexed by hugo symbol."""
+    transcripts = ensembl_canonical['transcript_stable_id'].copy()
+    explanations = ensembl_canonical['explanation'].copy()
+    # apply the tables with the lowest precedence first, so the others overwrite them
+    for overrides, overrides_table_name in reversed(list(zip(overrides_tables, overrides_table_names))):
+        # corner case when there are multiple overrides for a given gene symbol, use the first
+        isoform_overrides = overrides.loc[~overrides.index.duplicated(), 'isoform_override']
+        has_override = hugos.isin(isoform_overrides.index)
+        transcripts[has_override] = isoform_overrides.reindex(hugos[has_override]).values
+        explanations[has_override] = overrides_table_name
+    return transcripts, explanations
+
+
+def get_hgnc_symbols(hgnc_df):
+    """Return the set of approved symbols, synonyms and previous symbols in the HGNC table, which is
+    indexed by approved symbol"""
+    return AliasIndex.from_table(hgnc_df, ['synonyms', 'previous_symbols']).symbols()
+
+
+def get_canonical_transcripts(hugos, hgnc_df, ensembl_canonical_index, oncokb, mskcc, uniprot, custom):
+    """Determine the ensembl canonical gene and transcript, and the canonical transcript of each
+    override chain for all hugo symbols. Returns a DataFrame with the CANONICAL_TRANSCRIPT_COLUMNS,
+    indexed by hugo symbol."""
+    hugos = pd.Index(hugos)
+    # based on hgnc mappings to ensembl id, the ensembl pick is shared by all override chains
+    ensembl_canonical = ensembl_canonical_index.resolve(hugos, hgnc_df['ensembl_gene_id'].reindex(hugos).values)
+
+    canonical_transcripts = pd.DataFrame(index=hugos, columns=CANONICAL_TRANSCRIPT_COLUMNS, dtype=object)
+    canonical_transcripts['ensembl_canonical_gene'] = ensembl_canonical['gene_stable_id']
+    canonical_transcripts['ensembl_canonical_transcript'] = ensembl_canonical['transcript_stable_id']
+    canonical_transcripts['ensembl_canonical_transcript_explanation'] = ensembl_canonical['explanation']
+    override_chains = [
+        ('genome_nexus', [custom], ["genome nexus isoform override"]),
+        ('uniprot', [custom, uniprot], ["manually override", "uniprot isoform override"]),
+        ('mskcc', [oncokb, mskcc, custom, uniprot], ["oncokb isoform override", "mskcc isoform override", "manually override", "uniprot isoform override"]),
+    ]
+    for name, overrides_tables, overrides_table_names in override_chains:
+        transcripts, explanations = get_overrides_transcripts(hugos, overrides_tables, overrides_table_names, ensembl_canonical)
+        canonical_transcripts[name + '_canonical_transcript'] = transcripts
+        canonical_transcripts[name + '_canonical_transcript_explanation'] = explanations
+    return canonical_transcripts
 
 
-def get_overrides_transcript(overrides_tables, ensembl_table, ensembl_table_indexed_by_gene_stable_id, hgnc_symbol, hgnc_canonical_genes, overrides_table_names):
-    """Find canonical transcript id for given hugo symbol. Overrides_tables is
-    a list of different override tables"""
-    for index in range(len(overrides_tables)):
-        overrides = overrides_tables[index]
-        try:
-            # corner case when there are multiple overrides for a given gene symbol
-            if overrides.loc[hgnc_symbol].ndim > 1:
-                transcript = overrides.loc[hgnc_symbol].isoform_override.values[0]
-                isoform_override = overrides_table_names[index]
-            else:
-                transcript = overrides.loc[hgnc_symbol].isoform_override
-                isoform_override = overrides_table_names[index]
-            # return transcript and isoform_override_explanation
-            return transcript, isoform_override
-        except KeyError:
-            pass
-    # get ensembl canonical version otherwise
-    return get_ensembl_canonical_transcript_id_from_hgnc_then_ensembl(ensembl_table, ensembl_table_indexed_by_gene_stable_id, hgnc_symbol, hgnc_canonical_genes, 'transcript_stable_id')
-
-def pick_canonical_longest_transcript_from_ensembl_table(ensembl_rows, field):
-    """Get canonical transcript id with largest protein length or if there is
-    no such thing, pick biggest gene id"""
-    return ensembl_rows.sort_values('is_canonical protein_length gene_stable_id'.split(), ascending=False)[field].values[0], "ensembl longest"
-
-def get_ensembl_canonical(ensembl_rows, field):
-
-    if (ensembl_rows.ndim == 1 and len(ensembl_rows) == 0) or (ensembl_rows.ndim == 2 and len(ensembl_rows) == 0):
-        return np.nan, np.nan
-    elif ensembl_rows.ndim == 1:
-        # this gene onlyhas one transcript from ensembl_table
-        return ensembl_rows[field], "ensembl only one transcript"
-    elif ensembl_rows.ndim == 2:
-        # there are multiple transcripts found by hugo_symbol or ensembl_gene_id
-        # we need to pick the longest transcript in this case
-        return pick_canonical_longest_transcript_from_ensembl_table(ensembl_rows, field)
-
-def get_ensembl_canonical_transcript_id_from_hgnc_then_ensembl(ensembl_table, ensembl_table_indexed_by_gene_stable_id, hgnc_symbol, hgnc_canonical_genes, field):
-    """Determine canonical transcript based on hgnc mappings to ensembl id.
-    If not possible use ensembl's data.
-    ensembl_table is the same as ensembl_table_indexed_by_gene_stable_id
-    But ensembl_table has hugo_symbol as index
-    ensembl_table_indexed_by_gene_stable_id has gene_stable_id as index
-    Adding ensembl_table_indexed_by_gene_stable_id to improve performance since this is the most time consuming part
-    """
-    try:
-        # try to find hgnc_symbol from hgnc_canonical_genes
-        # it should only have one row returned, otherwise raise an exception
-        hgnc_gene_rows = hgnc_canonical_genes.loc[hgnc_symbol]
-    except KeyError:
-        raise(Exception("Unknown hugo symbol"))
-    if hgnc_gene_rows.ndim == 1:
-        try:
-            # from the only one record found in hgnc_canonical_genes, we could have the ensembl_gene_id from the record
-            # find transcripts from ensembl_table (same as ensembl_table_indexed_by_gene_stable_id) by searching ensembl_gene_id
-            # here we use ensembl_table_indexed_by_gene_stable_id instead to increase performance
-            # get_ensembl_canonical returns one transcript from all transcripts found by ensembl_gene_id
-            return get_ensembl_canonical(ensembl_table_indexed_by_gene_stable_id.loc[hgnc_gene_rows.ensembl_gene_id], field)
-        except KeyError:
-            # if couldn't find any transcripts by ensembl_gene_id, switch to searching by hgnc_symbol
-            # there's actually 222 of these (see notebook)
-            try:
-                return get_ensembl_canonical(ensembl_table.loc[hgnc_symbol], field)
-            except KeyError:
-                return np.nan, np.nan
-    else:
-        raise(Exception("One hugo symbol expected in hgnc_canonical_genes"))
-
-def get_transcript_id_and_explanation(transcript_info_df, transcript_info_indexed_by_gene_stable_id, hugo_symbol, hgnc_df, oncokb, mskcc, uniprot, custom):
-    ensembl_canonical_gene, ensembl_canonical_gene_explanation = get_ensembl_canonical_transcript_id_from_hgnc_then_ensembl(transcript_info_df, transcript_info_indexed_by_gene_stable_id, hugo_symbol, hgnc_df, 'gene_stable_id')
-    ensembl_canonical_transcript, ensembl_canonical_transcript_explanation = get_ensembl_canonical_transcript_id_from_hgnc_then_ensembl(transcript_info_df, transcript_info_indexed_by_gene_stable_id, hugo_symbol, hgnc_df, 'transcript_stable_id')
-    genome_nexus_overrides_transcript, genome_nexus_overrides_transcript_explanation = get_overrides_transcript([custom], transcript_info_df, transcript_info_indexed_by_gene_stable_id, hugo_symbol, hgnc_df, ["genome nexus isoform override"])
-    uniprot_overrides_transcript, uniprot_overrides_transcript_explanation = get_overrides_transcript([custom, uniprot], transcript_info_df, transcript_info_indexed_by_gene_stable_id, hugo_symbol, hgnc_df, [ "manually override", "uniprot isoform override"])
-    mskcc_overrides_transcript, mskcc_overrides_transcript_explanation = get_overrides_transcript([oncokb, mskcc, custom, uniprot], transcript_info_df, transcript_info_indexed_by_gene_stable_id, hugo_symbol, hgnc_df, ["oncokb isoform override", "mskcc isoform override", "manually override", "uniprot isoform override"])
-    return pd.Series([
-                ensembl_canonical_gene,
-                ensembl_canonical_transcript,
-                ensembl_canonical_transcript_explanation,
-                genome_nexus_overrides_transcript,
-                genome_nexus_overrides_transcript_explanation,
-                uniprot_overrides_transcript,
-                uniprot_overrides_transcript_explanation,
-                mskcc_overrides_transcript,
-                mskcc_overrides_transcript_explanation
-            ],
-            index="""
-            ensembl_canonical_gene
-            ensembl_canonical_transcript
-            ensembl_canonical_transcript_explanation
-            genome_nexus_canonical_transcript
-            genome_nexus_canonical_transcript_explanation
-            uniprot_canonical_transcript
-            uniprot_canonical_transcript_explanation
-            mskcc_canonical_transcript
-            mskcc_canonical_transcript_explanation
-            """
-            .split()
-        )
-
 def lowercase_set(x):
     return set({i.lower() for i in x})
 
@@ -127,7 +90,7 @@ def main(ensembl_biomart_geneids_transcript_info,
          ignored_genes_file_name,
          ensembl_biomart_canonical_transcripts_per_hgnc):
     # input files
-    transcript_info_df = pd.read_csv(ensembl_biomart_geneids_transcript_info, sep='\t', dtype={'is_canonical':bool})
+    transcript_info_df = intermediate_format.read_table(ensembl_biomart_geneids_transcript_info, dtype={'is_canonical':bool})
     transcript_info_df = transcript_info_df.drop_duplicates()
     uniprot = pd.read_csv(isoform_overrides_uniprot, sep='\t')\
         .rename(columns={'enst_id':'isoform_override'})\
@@ -172,10 +135,7 @@ def main(ensembl_biomart_geneids_transcript_info,
 
     # create hgnc_symbol to gene id mapping
     # ignore hugo symbols from ensembl data dump (includes prev symbols and synonyms)
-    syns = hgnc_df.synonyms.str.strip('"').str.split("|").dropna()
-    syns = set(itertools.chain.from_iterable(syns))
-    previous_symbols = hgnc_df.previous_symbols.str.strip('"').str.split("|").dropna()
-    previous_symbols = set(itertools.chain.from_iterable(previous_symbols))
+    hgnc_symbols = get_hgnc_symbols(hgnc_df)
 
     # there is overlap between symbols, synonyms and previous symbols
     # therefore use logic in above order when querying
@@ -186,8 +146,8 @@ def main(ensembl_biomart_geneids_transcript_info,
     # all cancer genes and hugo symbols in ensembl data dump should be
     # contained in hgnc approved symbols and synonyms
     # c12orf9 is only in sanger's cancer gene census and has been withdrawn
-    assert(len(lowercase_set(set(cgs)) - set(['c12orf9']) - lowercase_set(set(hugos).union(syns).union(previous_symbols))) == 0)
-    no_symbols_in_hgnc = lowercase_set(transcript_info_df.hgnc_symbol.dropna().unique()) - lowercase_set(set(hugos).union(syns).union(previous_symbols))
+    assert(len(lowercase_set(set(cgs)) - set(['c12orf9']) - lowercase_set(hgnc_symbols)) == 0)
+    no_symbols_in_hgnc = lowercase_set(transcript_info_df.hgnc_symbol.dropna().unique()) - lowercase_set(hgnc_symbols)
     new_genes = ignore_certain_genes(ignore_rna_gene(no_symbols_in_hgnc),ignored_genes_file_name)
     if len(new_genes) != 0:
         print('------ New genes need to be added into ignored_genes.txt ------\n' +
@@ -196,11 +156,7 @@ def main(ensembl_biomart_geneids_transcript_info,
         '------ End of new genes list ------\n')
     assert(len(new_genes) == 0)
 
-    transcript_info_df = transcript_info_df.set_index('hgnc_symbol').sort_index()
-    transcript_info_indexed_by_gene_stable_id = transcript_info_df
-    # duplicate a temp column to use as index
-    transcript_info_indexed_by_gene_stable_id["gene_stable_id_temp"] = transcript_info_df['gene_stable_id']
-    transcript_info_indexed_by_gene_stable_id = transcript_info_indexed_by_gene_stable_id.set_index('gene_stable_id_temp').sort_index()
+    ensembl_canonical_index = EnsemblCanonicalIndex(transcript_info_df)
 
     # for testing use
     # NSD3 replaces WHSC1L1
@@ -208,9 +164,7 @@ def main(ensembl_biomart_geneids_transcript_info,
     # there are multiple in ensembl data dump
     # hugos = ['KRT18P53', 'NSD3', 'AATF']
 
-    # TODO Optimize this part, as this part takes most time
-    one_transcript_per_hugo_symbol = pd.Series(hugos).apply(lambda x: get_transcript_id_and_explanation(transcript_info_df, transcript_info_indexed_by_gene_stable_id, x, hgnc_df, oncokb, mskcc, uniprot, custom ))
-    one_transcript_per_hugo_symbol.index = hugos
+    one_transcript_per_hugo_symbol = get_canonical_transcripts(hugos, hgnc_df, ensembl_canonical_index, oncokb, mskcc, uniprot, custom)
     one_transcript_per_hugo_symbol.index.name = 'hgnc_symbol'
 
     # merge in other hgnc fields
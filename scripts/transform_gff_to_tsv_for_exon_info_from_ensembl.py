@@ -5,58 +5,129 @@ This code is licensed under the GNU Affero General Public License (AGPL),
 version 3, or (at your option) any later version.
 """
 
-import pandas as pd
 import gzip
+import csv
+import itertools
+import collections
+import multiprocessing
 import argparse
+import intermediate_format
 
+# Columns of the output TSV, in the order they are written
+TRANSCRIPT_INFO_COLUMNS = list(intermediate_format.TRANSCRIPT_INFO_SCHEMA)
 
-def main(gff_file, ensembl_transcript_info):
-    """Transform GFF3 file to TSV for exons and UTRs. Output is written to
-    stdout, as the Makefile wrapper expects. Input file is GFF3 file, see Makefile"""
+# Number of GFF3 lines that are parsed before the resulting rows are written to the output
+CHUNK_SIZE = 100000
+
+
+def parse_gff_attributes(attributes):
+    """Return a dictionary of the key=value pairs in a GFF3 attributes column"""
+    attribute_dict = {}
+    for attribute in attributes.split(';'):
+        key, _, value = attribute.partition('=')
+        attribute_dict[key] = value
+    return attribute_dict
+
+
+def get_parent_transcript_id(attribute_dict):
+    """Return the transcript id from the Parent attribute, formatted as transcript:<transcript_id>"""
+    return attribute_dict['Parent'].split(':', 1)[1]
 
-    # Dataframe to append the transcript information
-    transcript_info = pd.DataFrame(columns=['transcript_id', 'type', 'id', 'start', 'end', 'rank', 'strand', 'version'])
-    # list to append transcript information per row
+
+def parse_gff_lines(lines):
+    """Parse GFF3 lines and return a list of rows (in the order of TRANSCRIPT_INFO_COLUMNS)
+    for every exon and UTR line. All other lines are skipped."""
     rows = []
+    for line in lines:
+        # cheap substring test first, so the other feature lines (genes, CDS, ...) are never split
+        if line[0] != '#' and ('\texon\t' in line or '_prime_UTR\t' in line):
+            list_line = line.strip('\n').split('\t')
+
+            # Extract UTRs and exons
+            if len(list_line) > 1 and list_line[2] in ['exon', 'five_prime_UTR', 'three_prime_UTR']:
+
+                strand = list_line[6]
+                # Convert plus strand into 1 and minus strand into -1
+                if strand == '+':
+                    strand = '1'
+                elif strand == '-':
+                    strand = '-1'
+                else:
+                    strand = ''
+
+                # look the attributes up by name, so their order in the file does not matter
+                attribute_dict = parse_gff_attributes(list_line[8])
+                transcript_id = get_parent_transcript_id(attribute_dict)
+                if list_line[2] == 'exon':
+                    exon_id = attribute_dict.get('exon_id', '')
+                    rank = attribute_dict.get('rank', '')
+                    version = attribute_dict.get('version', '')
+                else:
+                    exon_id = ''
+                    rank = ''
+                    version = ''
+                rows.append([transcript_id, list_line[2], exon_id, list_line[3], list_line[4], rank, strand, version])
+    return rows
+
 
-    # Open gff file and read lines, when line contains transcript information, extract this information
+def read_gff_chunks(gff, chunk_size):
+    """Yield lists of at most chunk_size lines from an open GFF3 file"""
+    while True:
+        lines = list(itertools.islice(gff, chunk_size))
+        if not lines:
+            return
+        yield lines
+
+
+def parse_gff_chunks_in_pool(chunks, workers):
+    """Parse chunks in a pool of worker processes and yield the parsed rows per chunk, in the
+    original order. At most 2 chunks per worker are in flight, to keep memory use bounded."""
+    with multiprocessing.Pool(workers) as pool:
+        pending = collections.deque()
+        for lines in chunks:
+            pending.append(pool.apply_async(parse_gff_lines, (lines,)))
+            if len(pending) >= 2 * workers:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+
+
+def transform_gff_to_tsv(gff_file, ensembl_transcript_info, chunk_size=CHUNK_SIZE, workers=1):
+    """Stream the gzipped GFF3 file in chunks of chunk_size lines and write the exon and UTR rows
+    to ensembl_transcript_info as they are parsed, so memory use does not grow with the size of
+    the annotation. With workers > 1 the chunks are parsed in parallel processes.
+    The output is written as Parquet when the file name ends with .parquet, and gzipped when
+    the file name has a .gz extension."""
     with gzip.open(gff_file, 'rt') as gff:
-        for line in gff:
-            if line[0] != '#':
-                list_line = line.strip('\n').split('\t')
-                entry_dict = {}
-
-                # Extract UTRs and exons
-                if len(list_line) > 1 and list_line[2] in ['exon', 'five_prime_UTR', 'three_prime_UTR']:
-
-                    meta_info = list_line[8].split(';')
-                    entry_dict['transcript_id'] = meta_info[0].split(':')[1]
-                    entry_dict['type'] = list_line[2]
-                    entry_dict['start'] = list_line[3]
-                    entry_dict['end'] = list_line[4]
-                    strand = list_line[6]
-                    # Convert plus strand into 1 and minus strand into -1
-                    if strand == '+':
-                        entry_dict['strand'] = '1'
-                    elif strand == '-':
-                        entry_dict['strand'] = '-1'
-                    else:
-                        entry_dict['strand'] = ''
-
-                    if list_line[2] == 'exon':
-                        entry_dict['id'] = meta_info[5].split('=')[1]
-                        entry_dict['rank'] = meta_info[6].split('=')[1]
-                        entry_dict['version'] = meta_info[7].split('=')[1]
-                    else:
-                        entry_dict['id'] = ''
-                        entry_dict['rank'] = ''
-                        entry_dict['version'] = ''
-                    rows.append(entry_dict)
-
-    # By first appending it to a list and only adding it to a DF once, performance is greatly improved
-    transcript_info = transcript_info.append(rows, ignore_index=True, sort=False)
-    transcript_info.to_csv(ensembl_transcript_info, sep='\t', index=False)
-    return
+        chunks = read_gff_chunks(gff, chunk_size)
+        if workers > 1:
+            parsed_chunks = parse_gff_chunks_in_pool(chunks, workers)
+        else:
+            parsed_chunks = map(parse_gff_lines, chunks)
+
+        if intermediate_format.is_parquet(ensembl_transcript_info):
+            writer = intermediate_format.ParquetChunkWriter(ensembl_transcript_info,
+                                                            intermediate_format.TRANSCRIPT_INFO_SCHEMA)
+            for rows in parsed_chunks:
+                writer.writerows(rows)
+            writer.close()
+            return
+
+        if '.gz' in ensembl_transcript_info:
+            out_file = gzip.open(ensembl_transcript_info, 'wt', newline='')
+        else:
+            out_file = open(ensembl_transcript_info, 'w', newline='')
+        with out_file:
+            # use the same dialect as DataFrame.to_csv, so the output does not change
+            writer = csv.writer(out_file, delimiter='\t', lineterminator='\n')
+            writer.writerow(TRANSCRIPT_INFO_COLUMNS)
+            for rows in parsed_chunks:
+                writer.writerows(rows)
+
+
+def main(gff_file, ensembl_transcript_info):
+    """Transform GFF3 file to TSV for exons and UTRs. Input file is GFF3 file, see Makefile"""
+    transform_gff_to_tsv(gff_file, ensembl_transcript_info)
 
 
 if __name__ == "__main__":
@@ -64,7 +135,15 @@ if __name__ == "__main__":
     parser.add_argument("gff_file",
                         help="tmp/annotations.gff3.gz")
     parser.add_argument("ensembl_transcript_info",
-                        help="tmp/ensembl_transcript_info.txt")
+                        help="tmp/ensembl_transcript_info.txt or tmp/ensembl_transcript_info.parquet")
+    parser.add_argument("-c", "--chunksize",
+                        help="The number of GFF3 lines that are parsed before the rows are written",
+                        default=CHUNK_SIZE,
+                        type=int)
+    parser.add_argument("-w", "--workers",
+                        help="The number of processes that parse GFF3 chunks in parallel",
+                        default=1,
+                        type=int)
     args = parser.parse_args()
 
-    main(args.gff_file, args.ensembl_transcript_info)
+    transform_gff_to_tsv(args.gff_file, args.ensembl_transcript_info, chunk_size=args.chunksize, workers=args.workers)
@@ -9,57 +9,84 @@ GENERAL_POPULATION_F_PREFIX = "f_"
 GENERAL_POPULATION_N_PREFIX = "n_"
 SIG_PREFIX = "Sig."
 
-
-def generate_count_list(mutation_row, tumor_types):
-    return [
-        {
-            "tumor_type": tumor_type,
-            "tumor_type_count": mutation_row[tumor_type + TUMOR_TYPE_COUNT_POSTFIX],
-            "variant_count": mutation_row[tumor_type + VARIANT_COUNT_POSTFIX]
-        } for tumor_type in tumor_types
+# columns that identify a mutation in every data frame
+MUTATION_KEY_COLUMNS = ["chromosome", "start_position", "end_position", "reference_allele", "variant_allele"]
+# key columns compared as strings, the positions are integers (see fix_na_values)
+MUTATION_KEY_STRING_COLUMNS = ["chromosome", "reference_allele", "variant_allele"]
+
+
+def generate_count_lists(mutations_df, tumor_types):
+    # one list of tumor type counts per row, built from whole columns
+    counts_per_tumor_type = [
+        [
+            {
+                "tumor_type": tumor_type,
+                "tumor_type_count": tumor_type_count,
+                "variant_count": variant_count
+            } for tumor_type_count, variant_count in zip(mutations_df[tumor_type + TUMOR_TYPE_COUNT_POSTFIX].tolist(),
+                                                         mutations_df[tumor_type + VARIANT_COUNT_POSTFIX].tolist())
+        ] for tumor_type in tumor_types
     ]
+    if not counts_per_tumor_type:
+        return [[] for _ in range(len(mutations_df))]
+    return [list(counts) for counts in zip(*counts_per_tumor_type)]
 
 
-def generate_stats_by_prefix(mutation_row, col_names, prefix):
-    return {
-        col_name.replace(prefix, "").lower(): mutation_row[col_name] for col_name in col_names
-    }
+def generate_stats_by_prefix(mutations_df, col_names, prefix):
+    # one dict per row, the keys are the column names without prefix
+    keys = [col_name.replace(prefix, "").lower() for col_name in col_names]
+    if not keys:
+        return [{} for _ in range(len(mutations_df))]
+    return [dict(zip(keys, values)) for values in zip(*[mutations_df[col_name].tolist() for col_name in col_names])]
 
 
-def generate_general_population_stats(mutation_row, count_col_names, freq_col_names):
+def generate_general_population_stats(mutations_df, count_col_names, freq_col_names):
     # add the lists for count and frequency stats
-    return {
-        "counts": generate_stats_by_prefix(
-            mutation_row,
-            count_col_names,
-            GENERAL_POPULATION_N_PREFIX
-        ),
-        "frequencies": generate_stats_by_prefix(
-            mutation_row,
-            freq_col_names,
-            GENERAL_POPULATION_F_PREFIX
+    return [
+        {
+            "counts": counts,
+            "frequencies": frequencies
+        } for counts, frequencies in zip(
+            generate_stats_by_prefix(mutations_df, count_col_names, GENERAL_POPULATION_N_PREFIX),
+            generate_stats_by_prefix(mutations_df, freq_col_names, GENERAL_POPULATION_F_PREFIX)
         )
-    }
-
-
-def generate_tumor_type_stats(mutation_row, sig_col_names):
-    return {
-        "tumor_type": mutation_row["Proposed_level"],
-        "n_cancer_type_count": mutation_row["n_cancer_type_count"],
-        "f_cancer_type_count": mutation_row["f_cancer_type_count"],
-        "f_biallelic": mutation_row["f_biallelic"],
-        "age_at_dx": mutation_row["age_at_dx"],
-        "tmb": mutation_row["tmb"],
-        "msi_score": mutation_row["msi_score"],
-        "n_with_sig": mutation_row["n_with_sig"],
-        "signatures": generate_stats_by_prefix(mutation_row, sig_col_names, SIG_PREFIX),
-        "hrd_score": {
-            "lst": mutation_row["lst"],
-            "ntelomeric_ai": mutation_row["ntelomeric_ai"],
-            "fraction_loh": mutation_row["fraction_loh"],
-        },
-        "n_germline_homozygous": mutation_row["n_germline_homozygous"]
-    }
+    ]
+
+
+def generate_tumor_type_stats(mutations_df, sig_col_names):
+    columns = [mutations_df[col_name].tolist() for col_name in ["Proposed_level",
+                                                                "n_cancer_type_count",
+                                                                "f_cancer_type_count",
+                                                                "f_biallelic",
+                                                                "age_at_dx",
+                                                                "tmb",
+                                                                "msi_score",
+                                                                "n_with_sig",
+                                                                "lst",
+                                                                "ntelomeric_ai",
+                                                                "fraction_loh",
+                                                                "n_germline_homozygous"]]
+    return [
+        {
+            "tumor_type": tumor_type,
+            "n_cancer_type_count": n_cancer_type_count,
+            "f_cancer_type_count": f_cancer_type_count,
+            "f_biallelic": f_biallelic,
+            "age_at_dx": age_at_dx,
+            "tmb": tmb,
+            "msi_score": msi_score,
+            "n_with_sig": n_with_sig,
+            "signatures": signatures,
+            "hrd_score": {
+                "lst": lst,
+                "ntelomeric_ai": ntelomeric_ai,
+                "fraction_loh": fraction_loh,
+            },
+            "n_germline_homozygous": n_germline_homozygous
+        } for (tumor_type, n_cancer_type_count, f_cancer_type_count, f_biallelic, age_at_dx, tmb, msi_score, n_with_sig,
+               lst, ntelomeric_ai, fraction_loh, n_germline_homozygous), signatures
+        in zip(zip(*columns), generate_stats_by_prefix(mutations_df, sig_col_names, SIG_PREFIX))
+    ]
 
 
 def extract_tumor_types_from_col_names(mutations_df):
@@ -79,8 +106,8 @@ def extract_col_names_by_prefix(mutations_df, stats_prefix):
 
 def process_data_frame(mutations_df, mutation_status):
     # add the list for tumor type counts
-    mutations_df["counts_by_tumor_type"] = mutations_df.apply(
-        lambda row: generate_count_list(row, extract_tumor_types_from_col_names(mutations_df)), axis=1
+    mutations_df["counts_by_tumor_type"] = pd.Series(
+        generate_count_lists(mutations_df, extract_tumor_types_from_col_names(mutations_df)), index=mutations_df.index
     )
     mutations_df["Mutation_Status"] = mutation_status
     # pick only the columns we need
@@ -110,12 +137,12 @@ def process_data_frame(mutations_df, mutation_status):
 
 def process_all_variant_freq_df(mutations_df, mutation_status):
     mutations_df["Mutation_Status"] = mutation_status
-    mutations_df["general_population_stats"] = mutations_df.apply(
-        lambda row: generate_general_population_stats(
-            row,
+    mutations_df["general_population_stats"] = pd.Series(
+        generate_general_population_stats(
+            mutations_df,
             extract_col_names_by_prefix(mutations_df, GENERAL_POPULATION_N_PREFIX),
             extract_col_names_by_prefix(mutations_df, GENERAL_POPULATION_F_PREFIX),
-        ), axis=1
+        ), index=mutations_df.index
     )
     # pick only the columns we need
     df = mutations_df[["Hugo_Symbol",
@@ -142,11 +169,11 @@ def process_all_variant_freq_df(mutations_df, mutation_status):
 
 def process_variants_by_cancertype_summary_df(mutations_df, mutation_status):
     mutations_df["Mutation_Status"] = mutation_status
-    mutations_df["stats_by_tumor_type"] = mutations_df.apply(
-        lambda row: generate_tumor_type_stats(
-            row,
+    mutations_df["stats_by_tumor_type"] = pd.Series(
+        generate_tumor_type_stats(
+            mutations_df,
             extract_col_names_by_prefix(mutations_df, SIG_PREFIX)
-        ), axis=1
+        ), index=mutations_df.index
     )
     # pick only the columns we need
     df = mutations_df[["Hugo_Symbol",
@@ -170,13 +197,12 @@ def process_variants_by_cancertype_summary_df(mutations_df, mutation_status):
 
 
 def create_variants_by_cancertype_summary_index(mutations_df):
-    # all other column names except stats_by_tumor_type
-    col_names = list(filter(lambda colname: colname != "stats_by_tumor_type", mutations_df.keys()))
-    # keep the first for every column except stats_by_tumor_type, they are the same
-    aggregator = {col_name: 'first' for col_name in col_names}
-    # aggregate stats_by_tumor_type as a list
-    aggregator['stats_by_tumor_type'] = lambda s: list(s)
-    return mutations_df.groupby('id').agg(aggregator).set_index("id").to_dict('index')
+    # aggregate stats_by_tumor_type as a list per mutation
+    mutation_keys = get_mutation_keys(mutations_df)
+    return mutations_df["stats_by_tumor_type"] \
+        .groupby([mutation_keys[col_name] for col_name in MUTATION_KEY_COLUMNS], sort=False, dropna=False) \
+        .agg(list) \
+        .reset_index()
 
 
 def process_msk_expert_review_df(mutations_df, mutation_status):
@@ -209,41 +235,24 @@ def merge_mutations(germline_mutations_df,
                     all_variants_freq_df,
                     msk_expert_review_df,
                     variants_by_cancertype_summary_df):
-    # generate ID for each data frame
-    generate_id(germline_mutations_df)
-    generate_id(biallelic_mutations_df)
-    generate_id(qc_pass_mutations_df)
-    generate_id(all_variants_freq_df)
-    generate_id(msk_expert_review_df)
-    generate_id(variants_by_cancertype_summary_df)
-
-    # create a dictionary for germline mutations
-    biallelic_mutations_index = biallelic_mutations_df.set_index("id").to_dict('index')
-    qc_pass_mutations_index = qc_pass_mutations_df.set_index("id").to_dict('index')
-    all_variants_freq_index = all_variants_freq_df.set_index("id").to_dict('index')
-    msk_expert_review_index = msk_expert_review_df.set_index("id").drop_duplicates().to_dict('index')
     variants_by_cancertype_summary_index = create_variants_by_cancertype_summary_index(
         variants_by_cancertype_summary_df)
 
     # add data from other sources into the main germline data frame
     add_column_data(germline_mutations_df,
-                    biallelic_mutations_index,
+                    biallelic_mutations_df,
                     "biallelic_counts_by_tumor_type",
                     "counts_by_tumor_type")
     add_column_data(germline_mutations_df,
-                    qc_pass_mutations_index,
+                    qc_pass_mutations_df,
                     "qc_pass_counts_by_tumor_type",
                     "counts_by_tumor_type")
     add_column_data(germline_mutations_df,
-                    all_variants_freq_index,
-                    "general_population_stats",
-                    "general_population_stats")
-    add_column_data(germline_mutations_df,
-                    all_variants_freq_index,
-                    "n_germline_homozygous",
-                    "n_germline_homozygous")
+                    all_variants_freq_df,
+                    ["general_population_stats", "n_germline_homozygous"],
+                    ["general_population_stats", "n_germline_homozygous"])
     add_column_data(germline_mutations_df,
-                    msk_expert_review_index,
+                    msk_expert_review_df.drop_duplicates(),
                     "msk_expert_review",
                     "msk_expert_review",
                     default_value=False)
@@ -252,34 +261,29 @@ def merge_mutations(germline_mutations_df,
                     "stats_by_tumor_type",
                     "stats_by_tumor_type")
 
-    # drop the id columns from the original data frames
-    germline_mutations_df.drop(columns=["id"], inplace=True)
-    biallelic_mutations_df.drop(columns=["id"], inplace=True)
-    qc_pass_mutations_df.drop(columns=["id"], inplace=True)
-    all_variants_freq_df.drop(columns=["id"], inplace=True)
-    msk_expert_review_df.drop(columns=["id"], inplace=True)
-    variants_by_cancertype_summary_df.drop(columns=["id"], inplace=True)
-
-
-def add_column_data(target_df, source_index, target_col_name, source_col_name, default_value=None):
-    target_df[target_col_name] = target_df.apply(
-        lambda row: pick_column_from_index(row["id"], source_index, source_col_name, default_value), axis=1
-    )
-
-
-def pick_column_from_index(row_id, source_index, source_col_name, default_value=None):
-    try:
-        return source_index[row_id][source_col_name]
-    except KeyError:
-        return default_value
-
 
-def generate_id(df):
-    df["id"] = df["chromosome"].map(str) + "_" + \
-               df["start_position"].map(str) + "_" + \
-               df["end_position"].map(str) + "_" + \
-               df["reference_allele"].map(str) + "_" + \
-               df["variant_allele"].map(str)
+def add_column_data(target_df, source_df, target_col_names, source_col_names, default_value=None):
+    """Add source columns to target_df, for the rows with the same mutation in source_df. Target rows
+    without a mutation in source_df get default_value, or NaN. A mutation must occur only once in
+    source_df."""
+    if isinstance(target_col_names, str):
+        target_col_names, source_col_names = [target_col_names], [source_col_names]
+    source_columns = pd.concat([get_mutation_keys(source_df), source_df[source_col_names]], axis=1)
+    merged = get_mutation_keys(target_df).merge(source_columns, how="left", on=MUTATION_KEY_COLUMNS,
+                                                validate="many_to_one")
+    for target_col_name, source_col_name in zip(target_col_names, source_col_names):
+        column = merged[source_col_name]
+        if default_value is not None:
+            column = column.fillna(default_value)
+        target_df[target_col_name] = column.values
+
+
+def get_mutation_keys(df):
+    """Return the mutation key columns of df, with the same types in every data frame"""
+    return pd.DataFrame({
+        col_name: df[col_name].map(str) if col_name in MUTATION_KEY_STRING_COLUMNS else df[col_name]
+        for col_name in MUTATION_KEY_COLUMNS
+    }, index=df.index)
 
 
 # workaround for mixed NAs and integers
@@ -7,12 +7,71 @@ version 3, or (at your option) any later version.
 """
 
 import unittest
+from unittest import mock
 import difflib
+import io
 import os
+import importlib.util
 import transform_gff_to_tsv_for_exon_info_from_ensembl
+import intermediate_format
 import gzip
 import hotspots.update_hotspots_to_grch38
 import requests
+import json
+import tempfile
+import threading
+import http.server
+import urllib.parse
+import re
+import pandas as pd
+import download_transcript_info_from_ensembl
+import http_cache
+import json_lines
+import ensembl_canonical_index
+import alias_index
+import make_one_canonical_transcript_per_gene
+import make_canonical_transcript_mouse
+import add_domains_hugo_ccds_refseq_exon_info_uniprot_to_ensembl_transcript as add_domains
+import transform_signal_db_mutations
+
+
+def start_stub_server(respond):
+    """Start a local HTTP server in a background thread, standing in for a remote web service.
+    respond(method, path, body) returns a (status code, headers dict, response body) tuple.
+    Returns the server, its base URL is 'http://localhost:<server.server_port>'."""
+    class StubHandler(http.server.BaseHTTPRequestHandler):
+        def handle_request(self):
+            length = int(self.headers.get('Content-Length', 0))
+            body = self.rfile.read(length).decode() if length else ''
+            status, headers, response_body = respond(self.command, self.path, body)
+            self.send_response(status)
+            for key, value in headers.items():
+                self.send_header(key, value)
+            self.end_headers()
+            self.wfile.write(response_body.encode())
+
+        do_GET = handle_request
+        do_POST = handle_request
+
+        def log_message(self, *args):
+            pass
+
+    server = http.server.ThreadingHTTPServer(('localhost', 0), StubHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def ensembl_lookup_response(method, path, body):
+    """Stub for Ensembl POST /lookup/id: ENST1 is canonical, and every id ending in 0 has no response"""
+    response = {}
+    for transcript_id in json.loads(body)['ids']:
+        if transcript_id.endswith('0'):
+            response[transcript_id] = None
+        else:
+            response[transcript_id] = {'is_canonical': int(transcript_id == 'ENST1'),
+                                       'Translation': {'id': transcript_id.replace('ENST', 'ENSP'), 'length': 100}}
+    return 200, {'Content-Type': 'application/json'}, json.dumps(response)
+
 
 class TransformTestCase(unittest.TestCase):
     """Superclass for testcases that test the transformation steps.
@@ -21,7 +80,7 @@ class TransformTestCase(unittest.TestCase):
     def assertFileGenerated(self, tmp_file_name, expected_file_name):
         """Assert that a file has been generated with the expected contents."""
         self.assertTrue(os.path.exists(tmp_file_name))
-        with gzip.open(tmp_file_name, 'rU') as out_file, gzip.open(expected_file_name, 'rU') as ref_file:
+        with gzip.open(tmp_file_name, 'rt') as out_file, gzip.open(expected_file_name, 'rt') as ref_file:
             base_filename = os.path.basename(tmp_file_name)
             base_input = os.path.basename(expected_file_name)
             diff_result = difflib.context_diff(
@@ -50,6 +109,505 @@ class TransformTestCase(unittest.TestCase):
         transform_gff_to_tsv_for_exon_info_from_ensembl.transform_gff_to_tsv(gff_input_file_name, out_file_name)
         self.assertFileGenerated(out_file_name, 'test_files/transform_gff_to_tsv/ensembl_transcript_info.txt.gz')
 
+    def test_gff_to_tsv_with_workers(self):
+        """Test that parsing the gff in parallel chunks gives the same output"""
+        out_file_name = 'test_files/transform_gff_to_tsv/ensembl_transcript_info_workers.txt.gz~'
+        gff_input_file_name = 'test_files/transform_gff_to_tsv/sub_Homo_Sapiens.gff3.gz'
+        transform_gff_to_tsv_for_exon_info_from_ensembl.transform_gff_to_tsv(gff_input_file_name, out_file_name,
+                                                                             chunk_size=10, workers=2)
+        self.assertFileGenerated(out_file_name, 'test_files/transform_gff_to_tsv/ensembl_transcript_info.txt.gz')
+
+    @unittest.skipUnless(importlib.util.find_spec('pyarrow'), 'pyarrow is not installed')
+    def test_gff_to_parquet(self):
+        """Test that the Parquet intermediate holds the same table as the TSV, with the schema types"""
+        out_file_name = 'test_files/transform_gff_to_tsv/ensembl_transcript_info~.parquet'
+        gff_input_file_name = 'test_files/transform_gff_to_tsv/sub_Homo_Sapiens.gff3.gz'
+        transform_gff_to_tsv_for_exon_info_from_ensembl.transform_gff_to_tsv(gff_input_file_name, out_file_name)
+        parquet_df = intermediate_format.read_table(out_file_name)
+        tsv_df = intermediate_format.read_table('test_files/transform_gff_to_tsv/ensembl_transcript_info.txt.gz')
+        self.assertEqual(list(tsv_df.columns), list(parquet_df.columns))
+        self.assertEqual('float64', parquet_df['rank'].dtype)
+        self.assertTrue(tsv_df.astype(parquet_df.dtypes.to_dict()).equals(parquet_df))
+        os.remove(out_file_name)
+
+    @unittest.skipUnless(importlib.util.find_spec('pyarrow'), 'pyarrow is not installed')
+    def test_parquet_empty_strand(self):
+        """Test that a row without strand is written to Parquet like it is to TSV, and exported as null"""
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            out_file_name = os.path.join(tmp_dir, 'ensembl_transcript_info.parquet')
+            writer = intermediate_format.ParquetChunkWriter(out_file_name, intermediate_format.TRANSCRIPT_INFO_SCHEMA)
+            writer.writerows([['ENST1', 'exon', 'E1', '1', '5', '1', '', '1'],
+                              ['ENST1', 'exon', 'E2', '8', '9', '2', '-1', '1']])
+            writer.close()
+            transcript_info = intermediate_format.read_table(out_file_name)
+        self.assertEqual('Int64', transcript_info['strand'].dtype)
+        self.assertTrue(pd.isnull(transcript_info.loc[0, 'strand']))
+        self.assertEqual(-1, transcript_info.loc[1, 'strand'])
+        exons = add_domains.get_info_dicts_per_transcript(transcript_info, ['id', 'strand'])
+        self.assertEqual([{'id': 'E1', 'strand': None}, {'id': 'E2', 'strand': -1}],
+                         json_lines.to_json_value(exons['ENST1']))
+
+    @unittest.skipUnless(importlib.util.find_spec('pyarrow'), 'pyarrow is not installed')
+    def test_mouse_canonical_from_parquet(self):
+        """Test that the mouse canonical transcripts are the same from the TSV and the Parquet canonical data"""
+        canonical_data = pd.DataFrame({'gene_stable_id': ['ENSMUSG1', 'ENSMUSG1', 'ENSMUSG2', 'ENSMUSG2'],
+                                       'transcript_stable_id': ['ENSMUST1', 'ENSMUST2', 'ENSMUST3', 'ENSMUST4'],
+                                       'hgnc_symbol': ['A', 'A', 'B', 'B'],
+                                       'hgnc_id': ['MGI:1', 'MGI:1', 'MGI:2', 'MGI:2'],
+                                       'is_canonical': [0, 1, 0, 0],
+                                       'protein_stable_id': ['ENSMUSP1', 'ENSMUSP2', float('nan'), 'ENSMUSP4'],
+                                       'protein_length': [300.0, 100.0, float('nan'), 50.0]})
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            canonical = {}
+            for extension in ['.txt', '.parquet']:
+                file_name = os.path.join(tmp_dir, 'ensembl_canonical_data' + extension)
+                intermediate_format.write_table(canonical_data, file_name, intermediate_format.CANONICAL_DATA_SCHEMA)
+                canonical[extension] = make_canonical_transcript_mouse.get_canonical_transcript_by_ensembl(file_name)
+        self.assertEqual(['ENSMUST2', 'ENSMUST4'], sorted(canonical['.txt']['transcript_stable_id']))
+        pd.testing.assert_frame_equal(canonical['.txt'], canonical['.parquet'])
+
+    def test_gff_attributes_in_any_order(self):
+        """Test that the exon and UTR attributes are read by name, not by position"""
+        lines = ['1\thavana\texon\t11869\t12227\t.\t+\t.\t'
+                 'Parent=transcript:ENST00000456328;Name=ENSE00002234944;constitutive=0;ensembl_end_phase=-1;'
+                 'ensembl_phase=-1;exon_id=ENSE00002234944;rank=1;version=1\n',
+                 '1\thavana\texon\t12613\t12721\t.\t-\t.\t'
+                 'rank=2;version=3;exon_id=ENSE00003582793;Parent=transcript:ENST00000456328\n',
+                 '1\thavana\tfive_prime_UTR\t65565\t65573\t.\t+\t.\tNote=x;Parent=transcript:ENST00000641515\n']
+        rows = transform_gff_to_tsv_for_exon_info_from_ensembl.parse_gff_lines(lines)
+        self.assertEqual([['ENST00000456328', 'exon', 'ENSE00002234944', '11869', '12227', '1', '1', '1'],
+                          ['ENST00000456328', 'exon', 'ENSE00003582793', '12613', '12721', '2', '-1', '3'],
+                          ['ENST00000641515', 'five_prime_UTR', '', '65565', '65573', '', '1', '']], rows)
+
+    def test_lookup_transcripts_concurrently(self):
+        """Test fetching transcript info with several requests in flight against a stub Ensembl server"""
+        server = start_stub_server(ensembl_lookup_response)
+        gene_info = pd.DataFrame({'transcript_stable_id': ['ENST%s' % i for i in range(1, 24)]})
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            store = download_transcript_info_from_ensembl.TranscriptInfoStore(os.path.join(tmp_dir, 'transcript_info.sqlite'))
+            jobs = download_transcript_info_from_ensembl.get_rest_jobs(store, gene_info['transcript_stable_id'])
+            transcript_info = download_transcript_info_from_ensembl.lookup_transcripts(
+                gene_info, store, jobs, query_size=5, concurrency=3,
+                server='http://localhost:%s' % server.server_port)
+            # resuming with a reordered and grown transcript list only looks up the new transcript
+            resumed_transcripts = pd.Series(['ENST24'] + list(reversed(gene_info['transcript_stable_id'])))
+            self.assertEqual({0}, download_transcript_info_from_ensembl.get_rest_jobs(store, resumed_transcripts))
+            store.close()
+        server.shutdown()
+        self.assertEqual(list(range(23)), list(transcript_info.index))
+        self.assertEqual('1', transcript_info.loc[0, 'is_canonical'])
+        self.assertEqual('0', transcript_info.loc[1, 'is_canonical'])
+        self.assertEqual('ENSP2', transcript_info.loc[1, 'protein_stable_id'])
+        self.assertTrue(pd.isnull(transcript_info.loc[9, 'protein_stable_id']))
+
+    def test_lookup_transcripts_retries_with_smaller_batches(self):
+        """Test that server errors are retried, with a smaller batch size"""
+        requested_batch_sizes = []
+
+        def overloaded_ensembl_response(method, path, body):
+            batch_size = len(json.loads(body)['ids'])
+            requested_batch_sizes.append(batch_size)
+            if batch_size > 2:
+                return 503, {'Retry-After': '0'}, ''
+            return ensembl_lookup_response(method, path, body)
+
+        server = start_stub_server(overloaded_ensembl_response)
+        gene_info = pd.DataFrame({'transcript_stable_id': ['ENST%s' % i for i in range(1, 8)]})
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            store = download_transcript_info_from_ensembl.TranscriptInfoStore(os.path.join(tmp_dir, 'transcript_info.sqlite'))
+            jobs = download_transcript_info_from_ensembl.get_rest_jobs(store, gene_info['transcript_stable_id'])
+            transcript_info = download_transcript_info_from_ensembl.lookup_transcripts(
+                gene_info, store, jobs, query_size=5, server='http://localhost:%s' % server.server_port)
+            store.close()
+        server.shutdown()
+        self.assertEqual([5, 2], requested_batch_sizes[:2])
+        self.assertEqual(list(range(7)), list(transcript_info.index))
+        self.assertEqual('ENSP7', transcript_info.loc[6, 'protein_stable_id'])
+
+    def test_lookup_transcripts_stops_after_failure(self):
+        """Test that a batch that fails for good stops the other workers and raises the error"""
+        requests_sent = []
+
+        def bad_request_response(method, path, body):
+            requests_sent.append(body)
+            if 'ENST1"' in body:
+                return 400, {}, ''
+            return ensembl_lookup_response(method, path, body)
+
+        server = start_stub_server(bad_request_response)
+        gene_info = pd.DataFrame({'transcript_stable_id': ['ENST%s' % i for i in range(1, 21)]})
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            store = download_transcript_info_from_ensembl.TranscriptInfoStore(os.path.join(tmp_dir, 'transcript_info.sqlite'))
+            jobs = download_transcript_info_from_ensembl.get_rest_jobs(store, gene_info['transcript_stable_id'])
+            with self.assertRaises(requests.exceptions.HTTPError):
+                download_transcript_info_from_ensembl.lookup_transcripts(
+                    gene_info, store, jobs, query_size=1, concurrency=2,
+                    server='http://localhost:%s' % server.server_port)
+            store.close()
+        server.shutdown()
+        # the other worker ends after its current batch, instead of looking up all 20
+        self.assertLessEqual(len(requests_sent), 3)
+
+    def test_http_cache(self):
+        """Test that responses are served from the cache, per request body, and in offline mode"""
+        requests_received = []
+
+        def counting_response(method, path, body):
+            requests_received.append(body)
+            return 200, {'Content-Type': 'application/json'}, json.dumps({'body': body})
+
+        server = start_stub_server(counting_response)
+        url = 'http://localhost:%s/lookup/id' % server.server_port
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            cache = http_cache.ResponseCache(os.path.join(tmp_dir, 'http_cache.sqlite'))
+            self.assertEqual({'body': 'a'}, http_cache.request('POST', url, cache=cache, data='a').json())
+            with mock.patch('sys.stderr', new_callable=io.StringIO) as stderr:
+                self.assertEqual({'body': 'a'}, http_cache.request('POST', url, cache=cache, data='a').json())
+            # responses from the cache are logged
+            self.assertIn('Using cached response from', stderr.getvalue())
+            self.assertIn('POST %s' % url, stderr.getvalue())
+            self.assertEqual({'body': 'b'}, http_cache.request('POST', url, cache=cache, data='b').json())
+            self.assertEqual(['a', 'b'], requests_received)
+
+            cache.offline = True
+            self.assertEqual({'body': 'b'}, http_cache.request('POST', url, cache=cache, data='b').json())
+            with self.assertRaises(http_cache.CacheMissError):
+                http_cache.request('POST', url, cache=cache, data='c')
+            cache.close()
+        server.shutdown()
+
+    @unittest.skipUnless(all(importlib.util.find_spec(module) for module in ['wget', 'Levenshtein']),
+                         'wget or Levenshtein is not installed')
+    def test_offline_cache_miss_fails_at_once(self):
+        """Test that a cache miss in offline mode is not retried by the Ensembl and BioMart fetchers"""
+        import enst_to_uniprot_mapping
+        gene_info = pd.DataFrame({'transcript_stable_id': ['ENST%s' % i for i in range(1, 21)]})
+        with tempfile.TemporaryDirectory() as tmp_dir, \
+                mock.patch.dict(os.environ, {'HTTP_CACHE_FILE': os.path.join(tmp_dir, 'http_cache.sqlite'),
+                                             'HTTP_CACHE_OFFLINE': '1'}), \
+                mock.patch('time.sleep') as sleep:
+            http_cache._default_cache = None
+            try:
+                store = download_transcript_info_from_ensembl.TranscriptInfoStore(os.path.join(tmp_dir, 'transcript_info.sqlite'))
+                jobs = download_transcript_info_from_ensembl.get_rest_jobs(store, gene_info['transcript_stable_id'])
+                with self.assertRaises(http_cache.CacheMissError):
+                    download_transcript_info_from_ensembl.lookup_transcripts(
+                        gene_info, store, jobs, query_size=5, server='http://localhost:1')
+                store.close()
+                biomart_store = enst_to_uniprot_mapping.BiomartUniprotStore(os.path.join(tmp_dir, 'biomart.sqlite'))
+                with self.assertRaises(http_cache.CacheMissError):
+                    enst_to_uniprot_mapping.get_uniprot_from_biomart(
+                        pd.Series(['ENSP1', 'ENSP2']), biomart_store, 'grch37', server='http://localhost:1')
+                biomart_store.close()
+            finally:
+                http_cache.get_default_cache().close()
+                http_cache._default_cache = None
+        sleep.assert_not_called()
+
+    def test_write_json_lines(self):
+        """Test that the streaming JSON writer gives the same output as DataFrame.to_json"""
+        domains = pd.DataFrame({'pfam_domain_id': ['PF00001'], 'pfam_domain_start': [1], 'pfam_domain_end': [50]})
+        df = pd.DataFrame({'transcript_stable_id': ['ENST1', 'ENST2', 'ENST3'],
+                           'protein_length': [101.0, float('nan'), 3.0],
+                           'hgnc_symbols': [['A/B', float('nan')], float('nan'), ['C']],
+                           'exons': [[{'id': 'ENSE1', 'start': 1, 'rank': 1.0}], float('nan'), []],
+                           'domains': [domains, float('nan'), float('nan')]})
+        expected = df.to_json(orient='records', lines=True)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            json_lines.write_json_lines(df, os.path.join(tmp_dir, 'transcripts.json'))
+            with open(os.path.join(tmp_dir, 'transcripts.json')) as json_file:
+                self.assertEqual(expected, json_file.read())
+            json_lines.write_json_lines(df, os.path.join(tmp_dir, 'transcripts.json.gz'), threads=2, block_size=10)
+            with gzip.open(os.path.join(tmp_dir, 'transcripts.json.gz'), 'rt') as json_file:
+                self.assertEqual(expected, json_file.read())
+
+    def test_ensembl_canonical_index(self):
+        """Test the canonical pick per gene id, and the fallback to the hugo symbol"""
+        transcript_info = pd.DataFrame({
+            'gene_stable_id': ['ENSG1', 'ENSG1', 'ENSG1', 'ENSG2', 'ENSG3'],
+            'transcript_stable_id': ['ENST1', 'ENST2', 'ENST3', 'ENST4', 'ENST5'],
+            'hgnc_symbol': ['A', 'A', 'A', 'B', 'C'],
+            'is_canonical': [False, True, False, True, False],
+            'protein_length': [300.0, 100.0, 200.0, 50.0, float('nan')]})
+        index = ensembl_canonical_index.EnsemblCanonicalIndex(transcript_info)
+        self.assertEqual(('ENSG1', 'ENST2', 'ensembl longest'), index.get('A', 'ENSG1'))
+        self.assertEqual(('ENSG3', 'ENST5', 'ensembl only one transcript'), index.get('C', 'ENSG_UNKNOWN'))
+        canonical = index.resolve(['A', 'B', 'D'], ['ENSG1', 'ENSG2', float('nan')])
+        self.assertEqual(['ENST2', 'ENST4'], list(canonical.transcript_stable_id[:2]))
+        self.assertTrue(pd.isnull(canonical.loc['D', 'transcript_stable_id']))
+
+    def test_alias_index(self):
+        """Test the precedence of approved symbols and aliases, and loading a saved index"""
+        genes = pd.DataFrame({'previous_symbols': ['OLD1, SHARED', float('nan'), 'B'],
+                              'synonyms': [float('nan'), 'SHARED, SYN2', 'SYN3']},
+                             index=['A', 'B', 'C'])
+        index = alias_index.AliasIndex.from_table(genes, ['previous_symbols', 'synonyms'], separator=',')
+        self.assertEqual('A', index.get('OLD1'))
+        self.assertEqual('A', index.get('SHARED'))
+        self.assertEqual('B', index.get('B'))
+        self.assertEqual('C', index.get('SYN3'))
+        self.assertIsNone(index.get('UNKNOWN'))
+        last_index = alias_index.AliasIndex.from_table(genes, ['previous_symbols', 'synonyms'], separator=',', keep='last')
+        self.assertEqual('B', last_index.get('SHARED'))
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            index.save(os.path.join(tmp_dir, 'alias_index.json'))
+            loaded_index = alias_index.AliasIndex.load(os.path.join(tmp_dir, 'alias_index.json'))
+        self.assertEqual(index.aliases, loaded_index.aliases)
+        self.assertEqual(index.approved_symbols, loaded_index.approved_symbols)
+
+    def test_alias_tokenisation_in_callers(self):
+        """Test that quoted and whitespace padded aliases resolve the same way in every caller"""
+        hgnc_df = pd.DataFrame({'previous_symbols': ['"OLD1| OLD2"', float('nan')],
+                                'synonyms': [float('nan'), ' SYN1 |'],
+                                'prev_symbol': ['"OLD1| OLD2"', float('nan')]},
+                               index=['A', 'B'])
+        self.assertEqual({'A', 'B', 'OLD1', 'OLD2', 'SYN1'},
+                         make_one_canonical_transcript_per_gene.get_hgnc_symbols(hgnc_df))
+
+        transcripts = pd.DataFrame({'hgnc_symbol': ['OLD1', 'OLD2', 'B']},
+                                   index=pd.Index(['ENST1', 'ENST2', 'ENST2'], name='transcript_stable_id'))
+        nested = add_domains.add_nested_hgnc(transcripts, hgnc_df)
+        self.assertEqual([['A'], ['A', 'B']], list(nested['hgnc_symbols']))
+
+        hugo_and_transcript_map = {'A': {'previous_symbols': '"OLD1, OLD2"', 'synonyms': float('nan')},
+                                   'B': {'previous_symbols': float('nan'), 'synonyms': ' SYN1 ,'}}
+        update_hotspots = hotspots.update_hotspots_to_grch38
+        self.assertEqual('A', update_hotspots.get_new_hugo_symbol('OLD1', hugo_and_transcript_map))
+        self.assertEqual('A', update_hotspots.get_new_hugo_symbol('OLD2', hugo_and_transcript_map))
+        self.assertEqual('B', update_hotspots.get_new_hugo_symbol('SYN1', hugo_and_transcript_map))
+        self.assertIsNone(update_hotspots.get_new_hugo_symbol('', hugo_and_transcript_map))
+
+    @unittest.skipUnless(importlib.util.find_spec('hgvs'), 'hgvs is not installed')
+    def test_count_hotspot_variant_types(self):
+        """Test counting the variant types of 2d hotspots, 3d hotspots get no counts"""
+        import hotspots.combine_2d_3d_add_mutation_type_counts_and_filter as combine
+        hotspots = pd.DataFrame({'type': ['single residue', 'in-frame indel', '3d', 'single residue'],
+                                 'residue': ['R175', '746-750', 'R273', 'X125'],
+                                 'variant_amino_acid': ['H:10|*:2|C:1', 'E746_A750del:5|K745_E746insIPVAIK:1',
+                                                        float('nan'), 'X125_splice:4']},
+                                index=[0, 1, 0, 2])
+        counts = combine.count_variant_types(hotspots)
+        self.assertEqual(list(hotspots.index), list(counts.index))
+        self.assertEqual([11, 2, 0, 0, 13], list(counts.iloc[0]))
+        self.assertEqual([0, 0, 6, 0, 6], list(counts.iloc[1]))
+        self.assertTrue(counts.iloc[2].isnull().all())
+        self.assertEqual([0, 0, 0, 4, 4], list(counts.iloc[3]))
+
+    @unittest.skipUnless(all(importlib.util.find_spec(module) for module in ['wget', 'Levenshtein']),
+                         'wget or Levenshtein is not installed')
+    def test_find_uniprot_ids_with_one_substitution(self):
+        """Test that only sequences of the same length with one substitution are found, in their order"""
+        import enst_to_uniprot_mapping
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            uniprot_fasta = os.path.join(tmp_dir, 'uniprot.fasta')
+            ensembl_fasta = os.path.join(tmp_dir, 'ensembl.fa')
+            with open(uniprot_fasta, 'w') as fasta_file:
+                fasta_file.write('>sp|P1|A_HUMAN A\nMKTA\nYIAK\n>sp|P2|B_HUMAN B\nMKTAYLAK\n>sp|P2-2|B_HUMAN B\nMKTAYLAK\n'
+                                 '>sp|P4|D_HUMAN D\nMRTAYIAK\n>sp|P5|E_HUMAN E\nMKTAYIA\n')
+            with open(ensembl_fasta, 'w') as fasta_file:
+                fasta_file.write('>ENSP1.1 pep\nMKTAYIAK\n>ENSP2.1 pep\nMKTAYVAK\n>ENSP3.2 pep\nMRTAYIAR\n')
+            sequence_to_uniprot_dict, sequence_length_dict = enst_to_uniprot_mapping.read_uniprot_sequences(uniprot_fasta)
+            ensp_to_sequence_digest_dict, unmatched_ensp_to_sequence_dict = \
+                enst_to_uniprot_mapping.read_ensembl_sequences(ensembl_fasta, sequence_to_uniprot_dict)
+        self.assertEqual(['P1', '', ''], list(enst_to_uniprot_mapping.get_uniprot_ids_with_isoform(
+            pd.Series(['ENSP1', 'ENSP2', '']), ensp_to_sequence_digest_dict, sequence_to_uniprot_dict)))
+        self.assertEqual({'ENSP2': 'MKTAYVAK', 'ENSP3': 'MRTAYIAR'}, unmatched_ensp_to_sequence_dict)
+        index = enst_to_uniprot_mapping.OneSubstitutionIndex(sequence_length_dict)
+        # a sequence of several UniProt ids is found once for every id, as before
+        self.assertEqual(['P1', 'P2,P2-2', 'P2,P2-2'], enst_to_uniprot_mapping.find_uniprot_ids_with_one_levenshtein_distance(
+            'MKTAYVAK', 'ENSP2', index, sequence_to_uniprot_dict))
+        self.assertEqual(['P4'], enst_to_uniprot_mapping.find_uniprot_ids_with_one_levenshtein_distance(
+            'MRTAYIAR', 'ENSP3', index, sequence_to_uniprot_dict))
+        self.assertIsNone(enst_to_uniprot_mapping.find_uniprot_ids_with_one_levenshtein_distance(
+            'MKTAYIAKQ', 'ENSP4', index, sequence_to_uniprot_dict))
+        # ENSP2 is curated with BioMart among the sequences with one substitution, ENSP5 by the reviewed mapping
+        df_transcript = pd.DataFrame({'ensp_id': ['ENSP1', 'ENSP2', 'ENSP3', 'ENSP5', ''],
+                                      'biomart_uniprot_id': ['', 'P1', '', '', ''],
+                                      'uniprot_id_with_isoform': ['P1', '', '', 'P6,P7', '']})
+        reviewed_mapping = pd.Series(['P8', 'P9'], index=['ENSP1', 'ENSP5'])
+        self.assertEqual(['P1', 'P1', 'P4', 'P9', ''], list(enst_to_uniprot_mapping.curation(
+            df_transcript, unmatched_ensp_to_sequence_dict, reviewed_mapping, index, sequence_to_uniprot_dict)))
+
+    @unittest.skipUnless(all(importlib.util.find_spec(module) for module in ['wget', 'Levenshtein']),
+                         'wget or Levenshtein is not installed')
+    def test_get_uniprot_from_biomart(self):
+        """Test fetching UniProt ids with concurrent POST queries to a stub BioMart, retrying failed queries,
+        and resuming from the store"""
+        import enst_to_uniprot_mapping
+        queried_ensp_ids = []
+        responses = []
+
+        def biomart_response(method, path, body):
+            query = urllib.parse.parse_qs(body)['query'][0]
+            ensp_ids = re.search('ensembl_peptide_id" value="([^"]*)"', query).group(1).split(',')
+            with lock:
+                responses.append(method)
+                # a server error and a truncated response are retried
+                if len(responses) == 1:
+                    return 503, {}, ''
+                if len(responses) == 2:
+                    return 200, {}, 'P1\tENSP1\n'
+                queried_ensp_ids.extend(ensp_ids)
+            # ENSP3 has no rows, ENSP2 has no Swiss-Prot id
+            rows = ['P%s\tENSP%s' % (ensp[4:], ensp[4:]) if ensp != 'ENSP2' else '\tENSP2'
+                    for ensp in ensp_ids if ensp != 'ENSP3']
+            return 200, {}, '\n'.join(rows + ['[success]']) + '\n'
+
+        lock = threading.Lock()
+        server = start_stub_server(biomart_response)
+        backoff_seconds = enst_to_uniprot_mapping.BIOMART_BACKOFF_SECONDS
+        enst_to_uniprot_mapping.BIOMART_BACKOFF_SECONDS = 0
+        try:
+            with tempfile.TemporaryDirectory() as tmp_dir:
+                store = enst_to_uniprot_mapping.BiomartUniprotStore(os.path.join(tmp_dir, 'biomart.sqlite'))
+                ensp_ids = pd.Series(['ENSP%s' % i for i in range(1, 8)] + ['', 'ENSP1'])
+                biomart_ensp_to_uniprot_dict = enst_to_uniprot_mapping.get_uniprot_from_biomart(
+                    ensp_ids, store, 'grch37', server='http://localhost:%s' % server.server_port,
+                    batch_size=3, concurrency=2)
+                # a second run with a new ENSP id only queries that one
+                enst_to_uniprot_mapping.get_uniprot_from_biomart(
+                    pd.Series(['ENSP8', 'ENSP3']), store, 'grch37', server='http://localhost:%s' % server.server_port)
+                store.close()
+        finally:
+            enst_to_uniprot_mapping.BIOMART_BACKOFF_SECONDS = backoff_seconds
+            server.shutdown()
+        self.assertEqual({'POST'}, set(responses))
+        self.assertEqual(['ENSP%s' % i for i in range(1, 9)], sorted(queried_ensp_ids))
+        self.assertEqual({'ENSP1': 'P1', 'ENSP2': '', 'ENSP4': 'P4', 'ENSP5': 'P5', 'ENSP6': 'P6', 'ENSP7': 'P7'},
+                         biomart_ensp_to_uniprot_dict)
+
+    @unittest.skipUnless(all(importlib.util.find_spec(module) for module in ['wget', 'Levenshtein']),
+                         'wget or Levenshtein is not installed')
+    def test_biomart_query_errors_are_not_retried(self):
+        """Test that rejected BioMart queries fail at once, without retries"""
+        import enst_to_uniprot_mapping
+        for status, body, error in [(200, 'Query ERROR: caught BioMart::Exception::Usage: Filter NOT FOUND\n', Exception),
+                                    (400, '', requests.exceptions.HTTPError)]:
+            responses = []
+
+            def biomart_response(method, path, request_body):
+                responses.append(method)
+                return status, {}, body
+
+            server = start_stub_server(biomart_response)
+            with mock.patch('time.sleep') as sleep, self.assertRaises(error):
+                enst_to_uniprot_mapping.request_uniprot_from_biomart('http://localhost:%s' % server.server_port, ['ENSP1'])
+            server.shutdown()
+            self.assertEqual(1, len(responses))
+            sleep.assert_not_called()
+
+    def test_generate_signal_db_stats(self):
+        """Test building the nested signalDB counts and population stats from the columns"""
+        mutations_df = pd.DataFrame({'Breast_tumortype_count': [10, 20], 'Breast_variant_count': [1.0, float('nan')],
+                                     'n_AFR': [5, 6], 'n_germline_homozygous': [0, 1], 'f_AFR': [0.5, 0.6]})
+        count_lists = transform_signal_db_mutations.generate_count_lists(mutations_df, ['Breast'])
+        self.assertEqual([{'tumor_type': 'Breast', 'tumor_type_count': 10, 'variant_count': 1.0}], count_lists[0])
+        self.assertEqual(2, len(count_lists))
+        self.assertEqual([[], []], transform_signal_db_mutations.generate_count_lists(mutations_df, []))
+        self.assertEqual([{'counts': {'afr': 6, 'germline_homozygous': 1}, 'frequencies': {'afr': 0.6}}],
+                         transform_signal_db_mutations.generate_general_population_stats(
+                             mutations_df,
+                             transform_signal_db_mutations.extract_col_names_by_prefix(mutations_df, 'n_'),
+                             transform_signal_db_mutations.extract_col_names_by_prefix(mutations_df, 'f_'))[1:])
+
+    def test_merge_signal_db_mutations(self):
+        """Test that the signalDB data is added to the germline mutations with the same mutation key"""
+        def mutations(keys, **columns):
+            df = pd.DataFrame(keys, columns=transform_signal_db_mutations.MUTATION_KEY_COLUMNS)
+            for col_name, values in columns.items():
+                df[col_name] = values
+            return df
+
+        germline = mutations([('1', 10, 10, 'A', 'T'), ('X', 20, 21, '-', 'GG'), ('1', 10, 10, 'A', 'C')])
+        biallelic = mutations([('1', 10, 10, 'A', 'C'), ('1', 10, 10, 'A', 'T')], counts_by_tumor_type=[['c'], ['t']])
+        qc_pass = mutations([('2', 10, 10, 'A', 'T')], counts_by_tumor_type=[['qc']])
+        all_variants_freq = mutations([('X', 20, 21, '-', 'GG')], general_population_stats=[{'counts': {}}],
+                                      n_germline_homozygous=[3])
+        msk_expert_review = mutations([('X', 20, 21, '-', 'GG'), ('X', 20, 21, '-', 'GG')], msk_expert_review=True)
+        summary = mutations([('1', 10, 10, 'A', 'T'), ('X', 20, 21, '-', 'GG'), ('1', 10, 10, 'A', 'T')],
+                            stats_by_tumor_type=[{'tumor_type': 'Breast'}, {'tumor_type': 'Lung'}, {'tumor_type': 'Lung'}])
+        transform_signal_db_mutations.merge_mutations(germline, biallelic, qc_pass, all_variants_freq,
+                                                      msk_expert_review, summary)
+        self.assertEqual([['t'], None, ['c']], list(germline['biallelic_counts_by_tumor_type'].where(
+            germline['biallelic_counts_by_tumor_type'].notnull(), None)))
+        self.assertTrue(germline['qc_pass_counts_by_tumor_type'].isnull().all())
+        self.assertEqual([None, 3.0, None], [None if pd.isnull(count) else count for count in germline['n_germline_homozygous']])
+        self.assertEqual([False, True, False], list(germline['msk_expert_review']))
+        self.assertEqual([{'tumor_type': 'Breast'}, {'tumor_type': 'Lung'}], germline.loc[0, 'stats_by_tumor_type'])
+        self.assertEqual(transform_signal_db_mutations.MUTATION_KEY_COLUMNS, list(germline.columns[:5]))
+
+    def test_update_hotspots_with_batched_sequences(self):
+        """Test that hotspots are lifted over with sequences from batched POST requests to a stub Ensembl"""
+        sequences = {'grch37': {'ENST1': 'MAAA', 'ENST2': 'MCCC', 'ENST3': 'MDDD'},
+                     'grch38': {'ENST1': 'MAAA', 'ENST21': 'MCCC', 'ENST31': 'MEEE'}}
+        requested_batches = []
+
+        def sequence_response(method, path, body):
+            if method != 'POST':
+                return 404, {}, ''
+            ids = json.loads(body)['ids']
+            requested_batches.append(ids)
+            server_sequences = sequences[path.split('/')[1]]
+            return 200, {'Content-Type': 'application/json'}, json.dumps(
+                [{'query': i, 'id': i.replace('ENST', 'ENSP'), 'seq': server_sequences[i]} for i in ids if i in server_sequences])
+
+        update_hotspots = hotspots.update_hotspots_to_grch38
+        server = start_stub_server(sequence_response)
+        servers = update_hotspots.ENSEMBL_GRCH37_SERVER, update_hotspots.ENSEMBL_GRCH38_SERVER
+        update_hotspots.ENSEMBL_GRCH37_SERVER = 'http://localhost:%s/grch37' % server.server_port
+        update_hotspots.ENSEMBL_GRCH38_SERVER = 'http://localhost:%s/grch38' % server.server_port
+        try:
+            with tempfile.TemporaryDirectory() as tmp_dir:
+                map_file_name = os.path.join(tmp_dir, 'canonical_transcripts_per_hgnc.txt')
+                pd.DataFrame({'hgnc_symbol': ['A', 'B', 'C'], 'previous_symbols': ['OLDA', float('nan'), float('nan')],
+                              'synonyms': [float('nan')] * 3, 'mskcc_canonical_transcript': ['ENST1', 'ENST21', 'ENST31']})\
+                    .to_csv(map_file_name, sep='\t', index=False)
+                hotspots_file_name = os.path.join(tmp_dir, 'hotspots.txt')
+                pd.DataFrame({'hugo_symbol': ['OLDA', 'B', 'C', 'UNKNOWN'], 'transcript_id': ['ENST1', 'ENST2', 'ENST3', 'ENST4']})\
+                    .to_csv(hotspots_file_name, sep='\t', index=False)
+                result_df = update_hotspots.generate_updated_grch38_hotspots_info(map_file_name, 'mskcc', hotspots_file_name,
+                                                                                  batch_size=2, workers=2)
+        finally:
+            update_hotspots.ENSEMBL_GRCH37_SERVER, update_hotspots.ENSEMBL_GRCH38_SERVER = servers
+            server.shutdown()
+        self.assertEqual(['OLDA', 'B'], list(result_df.hugo_symbol))
+        self.assertEqual(['ENST1', 'ENST21'], list(result_df.transcript_id))
+        self.assertEqual([['ENST1', 'ENST2'], ['ENST3'], ['ENST1', 'ENST21'], ['ENST31']], sorted(requested_batches[:2]) + sorted(requested_batches[2:]))
+
+    def test_update_hotspots_with_peptide_fasta(self):
+        """Test that hotspots are lifted over offline, with the sequences of peptide FASTA files"""
+        update_hotspots = hotspots.update_hotspots_to_grch38
+        servers = update_hotspots.ENSEMBL_GRCH37_SERVER, update_hotspots.ENSEMBL_GRCH38_SERVER
+        # unreachable servers, the test fails if they are queried
+        update_hotspots.ENSEMBL_GRCH37_SERVER = 'http://localhost:1/grch37_offline'
+        update_hotspots.ENSEMBL_GRCH38_SERVER = 'http://localhost:1/grch38_offline'
+        try:
+            with tempfile.TemporaryDirectory() as tmp_dir:
+                grch37_fasta = os.path.join(tmp_dir, 'grch37.pep.all.fa')
+                with open(grch37_fasta, 'w') as fasta_file:
+                    fasta_file.write('>ENSP1.1 pep transcript:ENST1.4 gene_symbol:A\nMAA\nAA\n'
+                                     '>ENSP2.1 pep transcript:ENST2.1 gene_symbol:B\nMCCC\n')
+                grch38_fasta = os.path.join(tmp_dir, 'grch38.pep.all.fa.gz')
+                with gzip.open(grch38_fasta, 'wt') as fasta_file:
+                    fasta_file.write('>ENSP1.2 pep transcript:ENST1.5 gene_symbol:A\nMAAAA\n'
+                                     '>ENSP21.1 pep transcript:ENST21.1 gene_symbol:B\nMCCD\n')
+                map_file_name = os.path.join(tmp_dir, 'canonical_transcripts_per_hgnc.txt')
+                pd.DataFrame({'hgnc_symbol': ['A', 'B'], 'previous_symbols': [float('nan')] * 2,
+                              'synonyms': [float('nan')] * 2, 'mskcc_canonical_transcript': ['ENST1', 'ENST21']})\
+                    .to_csv(map_file_name, sep='\t', index=False)
+                hotspots_file_name = os.path.join(tmp_dir, 'hotspots.txt')
+                pd.DataFrame({'hugo_symbol': ['A', 'B'], 'transcript_id': ['ENST1', 'ENST2']})\
+                    .to_csv(hotspots_file_name, sep='\t', index=False)
+                result_df = update_hotspots.generate_updated_grch38_hotspots_info(
+                    map_file_name, 'mskcc', hotspots_file_name,
+                    grch37_peptide_fasta_file_name=grch37_fasta, grch38_peptide_fasta_file_name=grch38_fasta)
+        finally:
+            update_hotspots.offline_ensembl_servers.difference_update([update_hotspots.ENSEMBL_GRCH37_SERVER,
+                                                                       update_hotspots.ENSEMBL_GRCH38_SERVER])
+            update_hotspots.ENSEMBL_GRCH37_SERVER, update_hotspots.ENSEMBL_GRCH38_SERVER = servers
+        self.assertEqual(['A'], list(result_df.hugo_symbol))
+        self.assertEqual(['ENST1'], list(result_df.transcript_id))
+
     def test_get_gene_and_transcript_map(self):
         hugo_and_transcript_map = hotspots.update_hotspots_to_grch38.get_gene_and_transcript_map('data/grch38_ensembl95/export/ensembl_biomart_canonical_transcripts_per_hgnc.txt')
         self.assertEqual('ENST00000646891', hugo_and_transcript_map['BRAF']['mskcc_canonical_transcript'])